@@ -0,0 +1,92 @@
+import pickle
+import collections
+import numpy as np
+
+import keras
+"""
+A batch generator that keeps the batches of another keras.utils.Sequence in
+memory, e.g. the validation data for the evaluation after every epoch. The
+batches of SQLBatchGenerators.SimpleBatchGenerator and
+MemmapBatchGenerators.MemmapBatchGenerator only depend on the shuffle seed and
+the epoch, therefore a batch that was evicted from the cache is fetched again
+with the same content.
+"""
+
+class CachedBatchGenerator(keras.utils.Sequence):
+  """ Serves the batches of a fixed epoch of a sequence from memory. The batches
+  are fetched once, on first use, and kept in a cache with least recently used
+  eviction.
+
+  Input
+  -----
+
+  sequence - the keras.utils.Sequence, which must be picklable and have an
+             epoch attribute that determines its batches. The cache works on
+             its own copy, the epoch of the copy is fixed to epoch.
+  epoch - the epoch of the sequence, which selects the (reproducible) batches
+  n_batches - the number of batches, by default all batches of the sequence
+  max_bytes - the memory budget of the cache in bytes, None for no limit
+  """
+  def __init__(self, sequence, epoch=0, n_batches=None, max_bytes=None):
+    # a sequence without an epoch may return different samples for the same
+    # index, then a batch fetched again after its eviction would differ
+    if not hasattr(sequence, 'epoch'):
+      raise ValueError("The batches of the sequence must be reproducible, i.e. only depend on "
+                       "its epoch (like SQLBatchGenerators.SimpleBatchGenerator)")
+    self.sequence = pickle.loads(pickle.dumps(sequence))
+    self.sequence.epoch = epoch
+    self.epoch = epoch
+    self.batch_size = getattr(sequence, 'batch_size', None)
+    self.n_batches = len(self.sequence) if n_batches is None else min(n_batches, len(self.sequence))
+    self.max_bytes = max_bytes
+
+    self.cache = collections.OrderedDict()
+    self.n_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    return
+
+  def _store(self, index, batch):
+    # adds a batch to the cache and evicts the least recently used batches
+    size = sum(a.nbytes for a in batch)
+    if self.max_bytes is not None and size > self.max_bytes:
+      return
+    self.cache[index] = batch
+    self.n_bytes += size
+    while self.max_bytes is not None and self.n_bytes > self.max_bytes:
+      _, evicted = self.cache.popitem(last=False)
+      self.n_bytes -= sum(a.nbytes for a in evicted)
+    return
+
+  def get_data(self, n_samples=None):
+    """ Returns (X, y) of the first batches with at least n_samples samples in
+    total (all batches by default), stacked into single arrays. The batches must
+    have the same number of cycles (no bucketing). """
+    Xs, ys = [], []
+    for k in range(self.n_batches):
+      if n_samples is not None and sum(len(y) for y in ys) >= n_samples:
+        break
+      X, y = self[k]
+      Xs.append(X)
+      ys.append(y)
+    return np.vstack(Xs), np.vstack(ys)
+
+  """
+  Functions to be implemented according to keras.utils.Sequence.
+  """
+  def __len__(self):
+    return self.n_batches
+
+  def __getitem__(self, index):
+    if index in self.cache:
+      self.hits += 1
+      self.cache.move_to_end(index)
+      return self.cache[index]
+    self.misses += 1
+    batch = self.sequence[index]
+    self._store(index, batch)
+    return batch
+
+  def on_epoch_end(self):
+    # the batches are the same in every epoch
+    pass
@@ -0,0 +1,167 @@
+import os
+import json
+import numpy as np
+
+import keras
+
+from QECDataGenerator import read_shape
+from SQLBatchGenerators import length_buckets, make_bucketed_batches
+"""
+Batch generators that read the columnar data sets written by
+QECDataGenerator.generate(..., backend='npy'). The columns are opened with
+memory mapping, such that the data is read from the page cache of the operating
+system, which is shared by all (forked) keras workers.
+"""
+
+class MemmapBatchGenerator(keras.utils.Sequence):
+  """ Like SQLBatchGenerators.SimpleBatchGenerator, this batch generator returns
+  the events and the final parity. 3/4 of every batch are taken from a random
+  order of all samples, which is reshuffled after every epoch, the remaining 1/4
+  from the samples with a non-trivial parity.
+
+  With bucketing (and always for data sets in the ragged layout), the batches
+  are instead made of samples with similar numbers of cycles, see
+  SQLBatchGenerators.make_bucketed_batches, and the events are only padded to
+  the longest sample of every batch. The number of time steps then varies
+  between batches, such that the model needs the input shape (None, dim_syndr).
+
+  Input
+  -----
+
+  path - the directory of the data set
+  batch_size - the number of samples per batch
+  shuffle_seed - seed of the random order, which only depends on shuffle_seed and
+                 the epoch, such that all worker processes agree on it
+  bucketing - whether batches are made of samples with similar lengths
+  n_buckets - the number of length buckets, see SQLBatchGenerators.length_buckets
+  """
+  def __init__(self, path, batch_size=16, shuffle_seed=0, bucketing=False, n_buckets=8):
+    self.path=path
+    self.batch_size=batch_size
+    self.shuffle_seed=shuffle_seed
+    self.epoch=0
+
+    with open(os.path.join(path, 'info.json')) as f:
+      self.info = json.load(f)
+    self.events_shape = read_shape(self.info['events_shape'])
+    self.dim_syndr = self.events_shape[-1]
+    self.ragged = self.info.get('layout') == 'ragged'
+    self.bucketing = bucketing or self.ragged
+    self.n_buckets = n_buckets
+
+    # process id of the process that opened the columns, see _load_data
+    self.load_pid=None
+    return
+
+  def _load_data(self):
+    """ Opens the columns with memory mapping, once per process. """
+    if self.load_pid == os.getpid():
+      return
+
+    def open_column(name):
+      return np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+
+    self.events = open_column('events')
+    if self.ragged:
+      self.offsets = open_column('offsets')
+    self.parity = open_column('parity')
+    self.length = open_column('length')
+    self.seed = open_column('seed')
+
+    # only samples that have been written are used
+    self.keys = np.flatnonzero(open_column('written'))
+    self.keys_nonull = self.keys[self.parity[self.keys]]
+    if self.bucketing:
+      self.bounds = length_buckets(self.length[self.keys], self.n_buckets)
+    self.order_epoch = None
+    self.load_pid = os.getpid()
+    return
+
+  def __getstate__(self):
+    # the memory maps are reopened after unpickling
+    state = self.__dict__.copy()
+    for key in ['events', 'offsets', 'parity', 'length', 'seed', 'keys', 'keys_nonull', 'bounds',
+                'order', 'order_nonull', 'batches']:
+      state.pop(key, None)
+    state['load_pid'] = None
+    return state
+
+  def _shuffle(self):
+    # random order of the samples in the current epoch
+    rng = np.random.RandomState([self.shuffle_seed, self.epoch])
+    if self.bucketing:
+      self.batches = make_bucketed_batches(self.keys, self.length[self.keys], self.batch_size,
+                                           self.bounds, rng)
+    else:
+      self.order = rng.permutation(self.keys)
+      self.order_nonull = rng.permutation(self.keys_nonull)
+    self.order_epoch = self.epoch
+
+  def _get_keys(self, index):
+    # the keys of batch number index
+    if self.order_epoch != self.epoch:
+      self._shuffle()
+    if self.bucketing:
+      return self.batches[index % len(self.batches)]
+    nrand = int(np.ceil(3*self.batch_size/4))
+    nnonull = self.batch_size - nrand
+    keys = np.take(self.order, np.arange(index*nrand, (index+1)*nrand), mode='wrap')
+    if len(self.order_nonull) > 0:
+      keys = np.concatenate((keys, np.take(self.order_nonull,
+                             np.arange(index*nnonull, (index+1)*nnonull), mode='wrap')))
+    return keys
+
+  def get_batch(self, keys):
+    """ Returns the batch (X, y) of the samples with the given keys. The rows are
+    gathered (in the order of the keys on disk) from the memory mapped columns
+    and unpacked in one call. With bucketing, the events are cut (or, in the
+    ragged layout, padded) to the longest sample of the batch. """
+    self._load_data()
+    keys = np.sort(keys)
+    n = len(keys)
+    if self.ragged:
+      X = self._gather_ragged(keys)
+    else:
+      X = np.unpackbits(self.events[keys], axis=1, count=int(np.prod(self.events_shape)))
+      X = X.astype(bool).reshape((n, ) + self.events_shape)
+      if self.bucketing:
+        X = X[:, :self.length[keys].max()]
+    y = self.parity[keys].reshape([n, 1])
+    return X, y
+
+  def _gather_ragged(self, keys):
+    # gathers the byte ranges of all samples from the flat buffer, unpacks them
+    # in one call and scatters the bits into an array padded to the longest sample
+    n = len(keys)
+    start, stop = self.offsets[keys], self.offsets[keys + 1]
+    n_bytes = stop - start
+    byte_start = np.cumsum(n_bytes) - n_bytes
+    byte_indcs = np.repeat(start - byte_start, n_bytes) + np.arange(n_bytes.sum())
+    bits = np.unpackbits(self.events[byte_indcs])
+
+    n_bits = self.length[keys] * self.dim_syndr
+    n_bits_max = n_bits.max()
+    # position of every valid bit in bits and in the padded batch
+    row = np.repeat(np.arange(n), n_bits)
+    pos = np.arange(n_bits.sum()) - np.repeat(np.cumsum(n_bits) - n_bits, n_bits)
+    X = np.zeros((n, n_bits_max), dtype=bool)
+    X[row, pos] = bits[np.repeat(8*byte_start, n_bits) + pos]
+    return X.reshape((n, n_bits_max // self.dim_syndr, self.dim_syndr))
+
+  """
+  Functions to be implemented according to keras.utils.Sequence.
+  """
+  def __len__(self):
+    self._load_data()
+    if self.bucketing:
+      if self.order_epoch != self.epoch:
+        self._shuffle()
+      return len(self.batches)
+    return int(np.ceil(len(self.keys)/float(self.batch_size)))
+
+  def __getitem__(self, index):
+    self._load_data()
+    return self.get_batch(self._get_keys(index))
+
+  def on_epoch_end(self):
+    self.epoch += 1
@@ -0,0 +1,138 @@
+import copy
+import pickle
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+"""
+A loader that assembles the batches of a keras.utils.Sequence (e.g.
+SQLBatchGenerators.SimpleBatchGenerator) in the background, ahead of the
+training step. The batches are computed by a pool of reader threads or processes
+and kept in a bounded queue, in the order of the sequence. The loader is a
+python generator, to be used with
+
+  model.fit_generator(generator=loader, steps_per_epoch=len(loader), workers=0)
+
+such that keras itself does not fork any workers.
+"""
+
+# the copy of the sequence of a reader thread or process, see _init_reader
+_reader = threading.local()
+
+def _init_reader(state):
+  # Every reader process unpickles its own copy of the sequence. Database
+  # connections can not be shared across processes, the copies open their own
+  # connections (see SimpleBatchGenerator.__getstate__).
+  _reader.sequence = pickle.loads(state)
+
+def _init_thread_reader(sequence):
+  # Every reader thread gets a shallow copy of the sequence, with its own epoch.
+  # The copies of a SimpleBatchGenerator share the index and the random orders,
+  # and only open their own connections (see SimpleBatchGenerator.__copy__).
+  _reader.sequence = copy.copy(sequence)
+
+def _read_batch(epoch, index):
+  """ Returns batch number index of the given epoch. The random order of the
+  sequence only depends on its epoch, such that all readers agree on it. """
+  sequence = _reader.sequence
+  if hasattr(sequence, 'epoch'):
+    sequence.epoch = epoch
+  return sequence[index]
+
+class PrefetchLoader:
+  """ Prefetches the batches of a keras.utils.Sequence.
+
+  Input
+  -----
+
+  sequence - the keras.utils.Sequence, which must be picklable
+  n_workers - the number of reader threads or processes. The readers mostly
+              wait for the database, a few of them keep up with the training
+  queue_size - the maximal number of batches that are prefetched
+  use_processes - if True, the batches are read by processes instead of threads
+
+  The loader records how long the training waited for batches, see stats.
+  """
+  def __init__(self, sequence, n_workers=4, queue_size=10, use_processes=False):
+    self.n_batches = len(sequence)
+    self.n_workers = n_workers
+    self.queue_size = queue_size
+    self.use_processes = use_processes
+
+    if use_processes:
+      self.executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_reader,
+                                          initargs=(pickle.dumps(sequence), ))
+    else:
+      self.executor = ThreadPoolExecutor(max_workers=n_workers, initializer=_init_thread_reader,
+                                         initargs=(sequence, ))
+    self.queue = queue.Queue(maxsize=queue_size)
+    self.stopped = threading.Event()
+
+    # starvation statistics, see stats
+    self.n_fetched = 0
+    self.n_starved = 0
+    self.wait_time = 0.
+    self.start_time = None
+
+    self.feeder = threading.Thread(target=self._feed, daemon=True)
+    self.feeder.start()
+    return
+
+  def _feed(self):
+    # submits the batches epoch by epoch, blocks while the queue is full
+    epoch = 0
+    while not self.stopped.is_set():
+      for index in range(self.n_batches):
+        future = self.executor.submit(_read_batch, epoch, index)
+        while not self.stopped.is_set():
+          try:
+            self.queue.put(future, timeout=0.1)
+            break
+          except queue.Full:
+            pass
+        if self.stopped.is_set():
+          future.cancel()
+          return
+      epoch += 1
+
+  def __len__(self):
+    return self.n_batches
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if self.start_time is None:
+      self.start_time = time.time()
+    if self.stopped.is_set():
+      raise StopIteration
+    future = self.queue.get()
+    if not future.done():
+      # the training has to wait for the readers
+      self.n_starved += 1
+      t = time.time()
+      batch = future.result()
+      self.wait_time += time.time() - t
+    else:
+      batch = future.result()
+    self.n_fetched += 1
+    return batch
+
+  def stats(self):
+    """ Returns the number of fetched batches, the number of batches that were
+    not ready when requested, the total time waited for them, and the fraction
+    of the time since the first request that was spent waiting. """
+    elapsed = time.time() - self.start_time if self.start_time is not None else 0.
+    return {'batches': self.n_fetched,
+            'starved_batches': self.n_starved,
+            'wait_time': self.wait_time,
+            'starved_fraction': self.wait_time / elapsed if elapsed > 0 else 0.}
+
+  def close(self):
+    """ Stops the feeder and the readers. """
+    self.stopped.set()
+    self.feeder.join()
+    while not self.queue.empty():
+      self.queue.get().cancel()
+    self.executor.shutdown(wait=True)
+    return
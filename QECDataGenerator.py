@@ -2,8 +2,12 @@ import sys
 
 import sqlite3
 import numpy as np
+import os
 import copy
+import json
 import time
+import collections
+from concurrent.futures import ProcessPoolExecutor
 
 def print_t(str_):
   ## 24 hour format ##
@@ -14,6 +18,261 @@ from SurfaceCode import SurfaceCode
 Generate data for surface17 code
 """
 
+def _simulate_shard(surf_params, seeds, n_steps_min, n_steps_max, first_index, mode,
+                    storage_version=1, pad=True, sampling='dense'):
+  """ Simulates the runs of one shard of seeds and returns the rows that are
+  written into the database. This is a module level function, such that it can
+  be executed by the worker processes of a ProcessPoolExecutor.
+  
+  Input
+  -----
+  
+  surf_params - keyword arguments of SurfaceCode (without the seed)
+  seeds - the seeds of this shard
+  n_steps_min, n_steps_max - range of the number of error cycles
+  first_index - position of the first seed of this shard in the data set
+  mode - 0, 1 or 2 (training, validation or test data), see generate
+  storage_version - the storage format of the rows, see generate
+  pad - whether the events are padded with zeros to n_steps_max, see convert_simple
+  sampling - the way the errors are sampled, see SurfaceCode.make_runs
+  """
+  surf = SurfaceCode(seed=0, **surf_params)
+  seeds, syndromes, events, fstabs, err_signals, parities = \
+    surf.make_runs(seeds, n_steps=n_steps_max, sampling=sampling)
+  runs = [(int(seeds[k]), syndromes[k], events[k], fstabs[k], err_signals[k], parities[k])
+          for k in range(len(seeds))]
+  
+  if mode == 0 or mode == 1:
+    runs = QECDataGenerator.convert_simple(runs, Nmin=n_steps_min, Nmax=n_steps_max,
+                                           first_index=first_index, pad=pad)
+  if storage_version == 2:
+    runs = [_pack_row(run, mode) for run in runs]
+  return runs
+
+def _pack_row(row, mode):
+  """ Packs the boolean events, err_signal and parities of a row into bits
+  (storage format 2). The parity of training and validation data is a single
+  boolean and is stored as before. """
+  if mode == 0 or mode == 1:
+    seed, event, err_sig, parity, length = row
+    return (seed, np.packbits(event), np.packbits(err_sig), parity, length)
+  seed, syndromes, events, fstabs, err_signals, parities = row
+  return (seed, syndromes, np.packbits(events), fstabs, np.packbits(err_signals),
+          np.packbits(parities))
+
+def read_storage_format(c):
+  """ Reads the storage format of a database from its info table.
+  
+  Input
+  -----
+  
+  c - a cursor of the database
+  
+  Output
+  ------
+  
+  A dictionary with the storage_version and, for storage_version 2, the shapes
+  (tuples) of the packed events, err_signal and parities and their dtype.
+  Databases written before the storage format was versioned have version 1,
+  in which every boolean is stored as one byte.
+  """
+  try:
+    c.execute('SELECT storage_version, events_shape, err_signal_shape, parities_shape, dtype FROM info')
+  except sqlite3.OperationalError:
+    return {'storage_version': 1}
+  version, events_shape, err_signal_shape, parities_shape, dtype = c.fetchone()
+  
+  return {'storage_version': version, 'events_shape': read_shape(events_shape),
+          'err_signal_shape': read_shape(err_signal_shape),
+          'parities_shape': read_shape(parities_shape), 'dtype': dtype}
+
+def read_shape(shape):
+  """ Converts a shape stored as a string "n1,n2,..." into a tuple. """
+  if shape is None:
+    return None
+  return tuple(int(n) for n in shape.split(','))
+
+def decode_int(value):
+  """ Training and validation data store the seed and the length as a np.array
+  (see convert_simple), test data stores the seed as an integer. This function
+  returns the integer. """
+  if isinstance(value, bytes):
+    return int(np.frombuffer(value, dtype=np.int64)[0])
+  return int(value)
+
+def _iter_chunks(seeds, chunk_size):
+  """ Generator that splits a sorted list of seeds into chunks of at most
+  chunk_size consecutive seeds. Gaps in the list of seeds start a new chunk. """
+  chunk = []
+  for seed in seeds:
+    if len(chunk) == chunk_size or (chunk and seed != chunk[-1] + 1):
+      yield chunk
+      chunk = []
+    chunk.append(seed)
+  if chunk:
+    yield chunk
+
+def _iter_shards(shards, n_workers):
+  """ Generator that simulates the shards and yields their rows in the order of
+  the shards. With n_workers > 1 the shards are simulated by a pool of worker
+  processes. At most 2*n_workers shards are in flight at any time, such that the
+  memory consumption does not grow with the number of shards.
+  
+  Input
+  -----
+  
+  shards - an iterable of argument tuples of _simulate_shard
+  n_workers - the number of worker processes
+  """
+  if n_workers <= 1:
+    for shard in shards:
+      yield _simulate_shard(*shard)
+    return
+
+  with ProcessPoolExecutor(max_workers=n_workers) as executor:
+    pending = collections.deque()
+    for shard in shards:
+      pending.append(executor.submit(_simulate_shard, *shard))
+      if len(pending) >= 2 * n_workers:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+def _grow_column(fname, column, shape):
+  """ Enlarges the .npy file fname of the memory mapped column to shape (along
+  the first axis) and returns the new column. The data is kept, the new entries
+  are zero (i.e. not written). """
+  tmp_fname = fname + '.tmp'
+  grown = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=column.dtype, shape=shape)
+  grown[:len(column)] = column
+  grown.flush()
+  del grown, column
+  os.replace(tmp_fname, fname)
+  return np.load(fname, mmap_mode='r+')
+
+class NpyDatasetWriter:
+  """ Writes a columnar data set into a directory. Every column is a .npy file
+  with one entry per sample, such that it can be opened with memory mapping:
+  
+  seed.npy - int64, the seeds
+  events.npy - uint8, the events packed into bits (np.packbits), one row per sample.
+               In the ragged layout the events are not padded, and all samples
+               are concatenated into a flat buffer.
+  offsets.npy - int64, only in the ragged layout, the events of sample k are
+                events[offsets[k]:offsets[k + 1]]
+  err_signal.npy - uint8, the final error signals packed into bits
+  parity.npy - bool, the final parities
+  length.npy - int64, the number of error cycles
+  written.npy - bool, whether the sample has been written
+  info.json - the parameters of the error model and the storage format
+  
+  Input
+  -----
+  
+  path - the directory of the data set
+  N0 - the first seed, sample k has the seed N0 + k
+  N_samples - the number of samples
+  shapes - the shapes of the events and err_signal, see QECDataGenerator.generate
+  entries - the parameters of the error model, like in the info table
+  resume - if True, an existing data set with the same parameters is continued.
+           Like a database, it can be extended to a larger N_samples, the
+           columns then grow to the new size.
+  lengths - the number of error cycles of every sample for the ragged layout, or
+            None for the padded layout
+  """
+  
+  columns = ['error_model_gitv', 'distance', 'pqx', 'pqy', 'pqz', 'pax', 'pay', 'paz', 'pm']
+  
+  def __init__(self, path, N0, N_samples, shapes, entries, resume=False, lengths=None):
+    self.path = path
+    self.N0 = N0
+    self.ragged = lengths is not None
+    
+    info = dict(zip(self.columns, entries))
+    info.update({'storage_version': 2, 'layout': 'ragged' if self.ragged else 'padded',
+                 'N0': N0, 'N_samples': N_samples, 'events_shape': shapes[0],
+                 'err_signal_shape': shapes[1], 'dtype': 'bool'})
+    events_bytes = (int(np.prod(read_shape(shapes[0]))) + 7) // 8
+    err_signal_bytes = (int(np.prod(read_shape(shapes[1]))) + 7) // 8
+    
+    info_fname = os.path.join(path, 'info.json')
+    if resume and os.path.exists(info_fname):
+      with open(info_fname) as f:
+        old_info = json.load(f)
+      # the size is not a parameter of the data set, it can be extended
+      N_existing = old_info.pop('N_samples')
+      if old_info != dict((key, info[key]) for key in info if key != 'N_samples'):
+        raise ValueError("Cannot resume " + path + ", it was generated with different "
+                         "parameters")
+      mode = 'r+'
+    else:
+      if not os.path.exists(path):
+        os.makedirs(path)
+      N_existing = 0
+      mode = 'w+'
+    
+    def open_column(name, dtype, shape):
+      fname = os.path.join(path, name + '.npy')
+      if mode == 'w+':
+        return np.lib.format.open_memmap(fname, mode=mode, dtype=dtype, shape=shape)
+      column = np.load(fname, mmap_mode='r+')
+      if len(column) < shape[0]:
+        column = _grow_column(fname, column, shape)
+      return column
+    
+    self.seed = open_column('seed', np.int64, (N_samples, ))
+    if self.ragged:
+      # the sizes of the samples are known in advance, such that the samples
+      # can be written in any order
+      dim_syndr = read_shape(shapes[0])[-1]
+      offsets = np.zeros(N_samples + 1, dtype=np.int64)
+      offsets[1:] = np.cumsum((np.asarray(lengths) * dim_syndr + 7) // 8)
+      self.offsets = open_column('offsets', np.int64, (N_samples + 1, ))
+      if N_samples > N_existing:
+        # the lengths of the existing samples do not change when the data set is
+        # extended (see QECDataGenerator.generate)
+        if not np.array_equal(self.offsets[:N_existing + 1], offsets[:N_existing + 1]):
+          raise ValueError("Cannot resume " + path + ", the lengths of the samples differ")
+        self.offsets[:] = offsets
+        self.offsets.flush()
+      self.events = open_column('events', np.uint8, (int(self.offsets[-1]), ))
+    else:
+      self.events = open_column('events', np.uint8, (N_samples, events_bytes))
+    self.err_signal = open_column('err_signal', np.uint8, (N_samples, err_signal_bytes))
+    self.parity = open_column('parity', bool, (N_samples, ))
+    self.length = open_column('length', np.int64, (N_samples, ))
+    self.written = open_column('written', bool, (N_samples, ))
+    
+    # the size is recorded after the columns have grown, a data set is never
+    # shrunk by resuming it with a smaller N_samples
+    info['N_samples'] = max(N_samples, N_existing)
+    with open(info_fname, 'w') as f:
+      json.dump(info, f)
+    
+  def write(self, rows):
+    """ writes rows in storage format 2, as returned by _simulate_shard """
+    seeds = np.array([int(row[0][0]) for row in rows])
+    idx = seeds - self.N0
+    self.seed[idx] = seeds
+    if self.ragged:
+      for (k, row) in zip(idx, rows):
+        self.events[self.offsets[k]:self.offsets[k + 1]] = row[1]
+    else:
+      self.events[idx] = np.stack([row[1] for row in rows])
+    self.err_signal[idx] = np.stack([row[2] for row in rows])
+    self.parity[idx] = [bool(row[3]) for row in rows]
+    self.length[idx] = [int(row[4][0]) for row in rows]
+    
+    # flush the data before it is marked as written
+    for column in [self.seed, self.events, self.err_signal, self.parity, self.length]:
+      column.flush()
+    self.written[idx] = True
+    self.written.flush()
+    
+  def close(self):
+    for column in [self.seed, self.events, self.err_signal, self.parity, self.length, self.written]:
+      column.flush()
+
 class QECDataGenerator:
   """Copyright 2017 Paul Baireuther. All Rights Reserved.
   ====================================================
@@ -44,14 +303,17 @@ class QECDataGenerator:
     if self.verbose not in [0,1]:
         raise ValueError("verbose must be either 0 or 1")
 
-  def convert_simple(self, data, Nmin, Nmax):
+  @staticmethod
+  def convert_simple(data, Nmin, Nmax, first_index=0, pad=True):
     
     # The circuit model outputs a final syndrome increment and a parity after
     # each error correction cycle. This function removes all of them except the
     # one after the last error correction cycle. The number of cycles iterates
-    # between Nmin and Nmax.
+    # between Nmin and Nmax. first_index is the position of the first run in
+    # the whole data set, such that data sets can be converted in pieces.
+    # With pad=False the events are not padded to Nmax (ragged layout).
     
-    n = Nmin
+    n = Nmin + first_index % (Nmax - Nmin + 1)
     data_converted = []
     for dat in data:
       seed, syndromes, events, fstabs, err_signals, parities = dat
@@ -60,7 +322,10 @@ class QECDataGenerator:
       # In the version used in [3] the network requires input vectors of
       # equal length, we therefore buffer the error cycles with zeros up
       # to the n_steps_max.
-      event = np.concatenate((events[:n], np.zeros((Nmax - n, d2), dtype=bool)), axis=0)
+      if pad:
+        event = np.concatenate((events[:n], np.zeros((Nmax - n, d2), dtype=bool)), axis=0)
+      else:
+        event = events[:n]
       err_sig = err_signals[n - 1]
       parity = parities[n - 1]
       length = n
@@ -80,7 +345,32 @@ class QECDataGenerator:
 
     return data_converted
 
-  def generate(self, _mode):
+  def generate(self, _mode, n_workers=1, chunk_size=1000, resume=False, storage_version=1,
+               backend='sqlite', ragged=False):
+    # The runs are simulated, converted and written in chunks of chunk_size
+    # seeds, with one transaction per chunk. Hence the memory consumption does
+    # not depend on the size of the data set. With n_workers > 1 the chunks are
+    # distributed over a pool of worker processes and the rows are streamed
+    # back to this process, which writes them into the database. Every seed is
+    # simulated independently, hence the data does not depend on n_workers or
+    # chunk_size.
+    #
+    # With resume=True an existing database is not overwritten. Only the seeds
+    # that are missing in it are simulated, which allows to continue a job that
+    # was killed, or to extend a data set to a larger size.
+    #
+    # storage_version = 1 stores every boolean as one byte, like the data sets
+    # used in [3]. storage_version = 2 packs the events, err_signal and parities
+    # into bits (np.packbits) and records their shapes and dtype in the info
+    # table, which reduces the size of the database by a factor of 8.
+    #
+    # backend = 'sqlite' writes a database, backend = 'npy' writes a columnar
+    # data set (see NpyDatasetWriter) into a directory, which can be read with
+    # memory mapping by MemmapBatchGenerators.MemmapBatchGenerator.
+    #
+    # With ragged=True (only with backend = 'npy') the events are not padded to
+    # n_steps_max, but stored in a flat buffer with an array of offsets.
+    
     # # # GIT VERSION # # #
     # If the error model is not under git version control,
     # this variable can be set to zero.
@@ -98,7 +388,12 @@ class QECDataGenerator:
     # mode = 2: testing data set, seeds from 2*10**8 ... 2*10**8 + N_test
     mode = _mode
 
-    """ WARNING: Existing databases will be overwritten! """
+    """ WARNING: Existing databases will be overwritten, unless resume=True! """
+    if backend not in ['sqlite', 'npy']:
+      raise ValueError("backend must be either 'sqlite' or 'npy'")
+    if ragged and backend != 'npy':
+      raise ValueError("ragged=True requires backend='npy'")
+
     # Directory where the database will be stored
     db_path = "./data/"
     
@@ -175,36 +470,87 @@ class QECDataGenerator:
     
     # # # DATABASE # # #
     
-    # Generate the database
-    conn = sqlite3.connect(db_path + fname)
-    c = conn.cursor()
-
-    # Create tables
-    c.execute('''DROP TABLE IF EXISTS data''')
-    c.execute('''DROP TABLE IF EXISTS info''')
-    conn.commit()
-
-    # Table with info about the error rates
-    c.execute('''CREATE TABLE info (error_model_gitv, distance, pqx, pqy, pqz, pax, pay, paz, pm)''')
     entries = [(error_model_gitv, dist, pqx, pqy, pqz, pax, pay, paz, pm)]
-    c.executemany('INSERT INTO info VALUES (?,?,?, ?,?,?, ?,?,?)', entries)
-    
+
+    # Shapes of the packed data (storage_version = 2)
+    n_anc = dist**2 - 1
     if mode == 0 or mode == 1:
-      # table for the data
-      c.execute('''CREATE TABLE data (seed, events, err_signal, parity INT, length)''')
-      # seed is unique index
-      c.execute('''CREATE UNIQUE INDEX idx_data_seed ON data(seed)''')
+      shapes = (str(n_steps_max) + "," + str(n_anc), str(n_anc // 2), None)
     elif mode == 2:
-      # table for the data
-      c.execute('''CREATE TABLE data (seed, syndromes, events, fstabs, err_signal, parities)''')
-      # seed is unique index
-      c.execute('''CREATE UNIQUE INDEX idx_data_seed ON data(seed)''')
+      shapes = (str(n_steps_max) + "," + str(n_anc), str(n_steps_max) + "," + str(n_anc // 2),
+                str(n_steps_max))
+
+    if backend == 'npy':
+      # Generate the columnar data set, which always stores packed data
+      if mode == 2:
+        raise ValueError("The npy backend supports only training and validation data")
+      storage_version = 2
+      fname = self.filename_base + suffix[:-len(".db")]
+      if ragged:
+        lengths = n_steps_min + np.arange(N_samples) % (n_steps_max - n_steps_min + 1)
+      else:
+        lengths = None
+      writer = NpyDatasetWriter(db_path + fname, N0, N_samples, shapes, entries[0], resume=resume,
+                                lengths=lengths)
+      seeds = [seed for seed in seeds if not writer.written[seed - N0]]
+      if resume:
+        print("Resuming: " + str(N_samples - len(seeds)) + " samples exist, " + str(len(seeds)) +
+              " samples are missing.")
+    elif backend == 'sqlite':
+      # Generate the database
+      conn = sqlite3.connect(db_path + fname)
+      c = conn.cursor()
+
+      # An existing database can only be resumed if it contains data that was
+      # generated with the same error model.
+      c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='data'")
+      resume = resume and c.fetchone() is not None
+      if resume:
+        c.execute('SELECT error_model_gitv, distance, pqx, pqy, pqz, pax, pay, paz, pm FROM info')
+        if c.fetchall() != entries:
+          raise ValueError("Cannot resume " + db_path + fname + ", it was generated with "
+                           "different parameters of the error model")
+        if read_storage_format(c)['storage_version'] != storage_version:
+          raise ValueError("Cannot resume " + db_path + fname + ", it was written in "
+                           "a different storage_version")
+        c.execute('SELECT seed FROM data')
+        existing = set(decode_int(s[0]) for s in c.fetchall())
+        seeds = [seed for seed in seeds if seed not in existing]
+        print("Resuming: " + str(len(existing)) + " samples exist, " + str(len(seeds)) +
+              " samples are missing.")
+      else:
+        # Create tables
+        c.execute('''DROP TABLE IF EXISTS data''')
+        c.execute('''DROP TABLE IF EXISTS info''')
+        conn.commit()
+
+        # Table with info about the error rates (and the storage format)
+        if storage_version == 1:
+          c.execute('''CREATE TABLE info (error_model_gitv, distance, pqx, pqy, pqz, pax, pay, paz, pm)''')
+          c.executemany('INSERT INTO info VALUES (?,?,?, ?,?,?, ?,?,?)', entries)
+        elif storage_version == 2:
+          c.execute('''CREATE TABLE info (error_model_gitv, distance, pqx, pqy, pqz, pax, pay, paz, pm,
+                       storage_version, events_shape, err_signal_shape, parities_shape, dtype)''')
+          c.executemany('INSERT INTO info VALUES (?,?,?, ?,?,?, ?,?,?, ?,?,?,?,?)',
+                        [entry + (storage_version, ) + shapes + ('bool', ) for entry in entries])
+        else:
+          raise ValueError("storage_version must be either 1 or 2")
+    
+        if mode == 0 or mode == 1:
+          # table for the data
+          c.execute('''CREATE TABLE data (seed, events, err_signal, parity INT, length)''')
+          # seed is unique index
+          c.execute('''CREATE UNIQUE INDEX idx_data_seed ON data(seed)''')
+        elif mode == 2:
+          # table for the data
+          c.execute('''CREATE TABLE data (seed, syndromes, events, fstabs, err_signal, parities)''')
+          # seed is unique index
+          c.execute('''CREATE UNIQUE INDEX idx_data_seed ON data(seed)''')
 
-    conn.commit()
+      conn.commit()
 
-    # # # GENERATE AN INSTANCE OF THE CIRCUIT MODEL # # #
-    surf = SurfaceCode(seed=0,
-                       git_version=error_model_gitv,
+    # # # PARAMETERS OF THE CIRCUIT MODEL # # #
+    surf_params = dict(git_version=error_model_gitv,
                        distance=dist,
                        pqx=pqx, pqy=pqy, pqz=pqz,
                        pax=pax, pay=pay, paz=paz,
@@ -215,45 +561,42 @@ class QECDataGenerator:
     # This is data that is used by the network during training (directly or
     # indirectly). Since we want to claim that the network can be trained on
     # experimentally accessible data we can only use a single final stabilizer
-    # measurement and parity from each run.
-
-    if mode == 0 or mode == 1:
-      # We evaluate the error circuit
-      runs = []
-      for k in range(len(seeds)):
-        runs.append(surf.make_run(seed=seeds[k], n_steps=n_steps_max, condensed=True))
-        if self.verbose==1:
-            if k%max(N_samples/20, 10)==0:
-               print_t("Steps done:{0}".format(k))
-
-      # We remove all data that could not be obtained in an experiment and also
-      # data that we do not need in order to to save memory (for example
-      # syndromes and error signals contain the same information, and the
-      # network uses only the error signals.
-      runs_processed = self.convert_simple(runs, Nmin=n_steps_min, Nmax=n_steps_max)
-
-      # save in database
-      c.executemany('REPLACE INTO data VALUES (?, ?, ?, ?, ?)', runs_processed)
-      conn.commit()
-      conn.close()
+    # measurement and parity from each run. We remove all data that could not
+    # be obtained in an experiment and also data that we do not need in order
+    # to to save memory (for example syndromes and error signals contain the
+    # same information, and the network uses only the error signals.
 
     # # # TESTING DATA # # #
 
     # During testing we "oversample" the output of the error model, i.e., we
     # store the final error signal and  parity after every stabilizer measurement
     # cycle.
-    if mode == 2:
-      # evaluate the error circuit
-      runs = []
-      for k in range(len(seeds)):
-        runs.append(surf.make_run(seed=seeds[k], n_steps=n_steps_max, condensed=True))
-        if self.verbose==1:
-            if k%max(N_samples/20, 10)==0:
-               print_t("Steps done:{0}".format(k))
-
-      # save in database
-      c.executemany('REPLACE INTO data VALUES (?, ?, ?, ?, ?, ?)', runs)
-      conn.commit()
+    if mode == 0 or mode == 1:
+      query = 'REPLACE INTO data VALUES (?, ?, ?, ?, ?)'
+    elif mode == 2:
+      query = 'REPLACE INTO data VALUES (?, ?, ?, ?, ?, ?)'
+
+    # We evaluate the error circuit chunk by chunk and commit each chunk to the
+    # database as it arrives. The cycle length of a sample depends on its
+    # position seed - N0 in the data set.
+    chunks = ((surf_params, chunk, n_steps_min, n_steps_max, chunk[0] - N0, mode, storage_version,
+               not ragged)
+              for chunk in _iter_chunks(seeds, chunk_size))
+
+    n_done = 0
+    for rows in _iter_shards(chunks, n_workers):
+      if backend == 'npy':
+        writer.write(rows)
+      else:
+        c.executemany(query, rows)
+        conn.commit()
+      n_done += len(rows)
+      if self.verbose==1:
+        print_t("Steps done:{0}".format(n_done))
+
+    if backend == 'npy':
+      writer.close()
+    else:
       conn.close()
         
     # Return the filename
@@ -1,5 +1,8 @@
 """
-    Everything is in this file, including the data generator, model, and testing logic.
+    The surface code simulation, data generator, model and testing logic are in
+    this file. The batches are read by SQLBatchGenerators.SimpleBatchGenerator,
+    prefetched by PrefetchLoader.PrefetchLoader and, for validation, kept in
+    memory by CachedBatchGenerators.CachedBatchGenerator.
 """
 import sys
 import time
@@ -18,6 +21,10 @@ import sqlite3
 import numpy as np
 import copy 
 
+from SQLBatchGenerators import SimpleBatchGenerator
+from PrefetchLoader import PrefetchLoader
+from CachedBatchGenerators import CachedBatchGenerator
+
 """Settings of data generation"""
 conf_generate_data=False
 conf_train_size=2000 # Use 4*10**4 for big, 2000 for small
@@ -995,248 +1002,10 @@ class QECDataGenerator:
     BATCH GENERATOR CODE
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 
-""" 
-The following is a simple batch generator, that generates only the syndromes (without final syndromes)
-and the measured parity 
-"""
-class SimpleBatchGenerator(keras.utils.Sequence):
-  def __init__(self, training_fname, validation_fname, test_fname, batch_size=16, mode='training'):
-    
-    self.dim_syndr = 8
-    self.n_steps_net2 = 4
-    
-    self.training_fname=training_fname
-    self.validation_fname=validation_fname
-    self.test_fname=test_fname
-    
-    self.batch_size=batch_size
-
-    if mode not in ['training', 'validation', 'test']:
-      raise ValueError("mode must be either 'training', 'validation' or 'test'")
-      
-    self.mode=mode
-    return
-  
-  def _load_data(self):
-    # Establish connections
-    self.training_conn = sqlite3.connect(self.training_fname)
-    self.validation_conn = sqlite3.connect(self.validation_fname)
-    self.test_conn = sqlite3.connect(self.test_fname)
-    
-    training_c = self.training_conn.cursor()
-    validation_c = self.validation_conn.cursor()
-    test_c = self.test_conn.cursor()
-    
-    # get all the seeds
-    training_c.execute('SELECT seed FROM data')
-    validation_c.execute('SELECT seed FROM data')
-    test_c.execute('SELECT seed FROM data')
-        
-    self.training_keys = list(sorted([s[0] for s in training_c.fetchall()]))
-    self.validation_keys = list(sorted([s[0] for s in validation_c.fetchall()]))
-    self.test_keys = list(sorted([s[0] for s in test_c.fetchall()]))
-
-    # checks that there is no overlapp in the seeds of the data sets
-    self.N_training = len(self.training_keys)
-    self.N_validation = len(self.validation_keys)
-    self.N_test = len(self.test_keys)
-    # all_keys = set(self.training_keys + self.validation_keys + self.test_keys)
-        
-    # if len(all_keys) < self.N_training + self.N_validation + self.N_test:
-    #   raise ValueError("There is overlap between the seeds of the training,  validation, and test sets. This"
-    #                      "is bad practice")
-    #   print("loaded databases and checked exclusiveness training, "
-    #           "validation, and test keys")
-    #   print("self.N_training=" + str(self.N_training) + ", self.N_validaiton=" + 
-    #         str(self.N_validation) + ", self.N_test=" + str(self.N_test) + ".")
-    return
-
-  def _close_databases(self):
-    """ This function closes all databases """
-    self.training_conn.close()
-    self.validation_conn.close()
-    self.test_conn.close()
-    return
-
-  def _fetch_n_records(self, n, offset=0):
-    # select data from the corresponding database
-    if self.mode == "training":
-      c = self.training_conn.cursor()
-    elif self.mode == "validation":
-      c = self.validation_conn.cursor()
-    elif self.mode == "test":
-      c = self.test_conn.cursor()
-    else:
-      raise ValueError("The only allowed data_types are: 'training','validation' and 'test'.")
-    
-    query="SELECT events, err_signal, parity, length FROM data ORDER BY RANDOM() LIMIT " + str(n)
-    if offset != 0:
-      query=query+" OFFSET " + str(offset)
-
-    c.execute(query)
-    # c.execute("SELECT events, err_signal, parity, length FROM data ORDER BY RANDOM() LIMIT ?", (1, ))
-    sample = c.fetchmany(n)
-    
-    return sample
-  
-  # fetch n records where the final parity is not null
-  def _fetch_n_records_nonull(self, n, offset=0):
-    
-    try:
-      self.tarining_conn
-      self.validation_conn
-      self.test_conn
-    except:
-      self._load_data()
-    
-    if self.mode == "training":
-      c = self.training_conn.cursor()
-    elif self.mode == "validation":
-      c = self.validation_conn.cursor()
-    elif self.mode == "test":
-      c = self.test_conn.cursor()
-    else:
-      raise ValueError("The only allowed data_types are: 'training','validation' and 'test'.")
-    
-    query="SELECT events, err_signal, parity, length FROM data WHERE hex(parity)='01' ORDER BY RANDOM() LIMIT " + str(n)
-    if offset != 0:
-      query=query+" OFFSET " + str(offset)
-    
-    c.execute(query)
-    samples=c.fetchmany(n)
-    return samples
-
-  def _fetch_one_batch(self):
-    # select data from the corresponding database
-    if self.mode == "training":
-      c = self.training_conn.cursor()
-    elif self.mode == "validation":
-      c = self.validation_conn.cursor()
-    elif self.mode == "test":
-      c = self.test_conn.cursor()
-    else:
-      raise ValueError("The only allowed data_types are: 'training','validation' and 'test'.")
-    
-    query="SELECT events, err_signal, parity, length FROM data ORDER BY RANDOM() LIMIT " + str(self.batch_size)
-    c.execute(query)
-    # c.execute("SELECT events, err_signal, parity, length FROM data ORDER BY RANDOM() LIMIT ?", (self.batch_size, ))
-    samples = c.fetchmany(self.batch_size)
-    
-    return samples
-  
-  def _convert_sample(self, sample):
-    """ formats a single batch of data
-    
-    Input
-    -----
-    
-    sample - raw data from the database
-    """
-    
-    syndr, fsyndr, parity, length = sample
-    n_steps = int(len(syndr) / self.dim_syndr)
-    
-    # # format into shape [steps, syndromes]
-    # syndr1 = np.fromstring(syndr, dtype=bool).reshape([n_steps, -1])
-    
-    # # get and set length information
-    # len1 = np.frombuffer(length, dtype=int)[0]
-    
-    # # the second length is set by n_steps_net2, except if len1 is shorter
-    # len2 = min(len1, self.n_steps_net2)
-    
-    # syndr2 = syndr1[len1 - len2:len1 - len2 + self.n_steps_net2]
-    # fsyndr = np.fromstring(fsyndr, dtype=bool)
-    # parity = np.frombuffer(parity, dtype=bool)
-    
-    syndr = np.fromstring(syndr, dtype=bool).reshape([n_steps, -1])
-    parity = np.frombuffer(parity, dtype=bool)
-    
-    return syndr, parity
-
-  def get_n_batches(self, n_batches):
-    self._load_data()
-    batches=[]
-    for k in range(n_batches):
-      fetched_samples=self._fetch_one_batch()
-      batch=[]
-      for j in range(len(fetched_samples)):
-        record=self._convert_sample(fetched_samples[j])
-        batch.append(record)
-      batches.append(batch)
-    return batches
-
-  def get_data_shape(self):
-    # self._load_data()
-    # samples=self._fetch_one_batch(10)
-    # batch=self._get_batch_from_sample(samples[0])
-    # self._close_databases()
-    # return batch
-    pass 
-
-  """
-  Functions to be implemented according to keras.utils.Sequence.
-  """
-  # A keras.utils.Sequence object must impement __len__ function
-  def __len__(self):
-    try:
-      self.N_training
-      self.N_validation
-      self.N_test
-    except:
-      self._load_data()
-    
-    if self.mode == "training":
-      return int(np.ceil(self.N_training/float(self.batch_size)))
-    elif self.mode == "validation":
-      return int(np.ceil(self.N_validation/float(self.batch_size)))
-    elif self.mode == "test":
-      return int(np.ceil(self.N_test/float(self.batch_size)))
-    return
-  
-  # A keras.utils.Sequence object must impement __getitem__ function
-  def __getitem__(self, index):
-    start = time.time()
-    try:
-      self.tarining_conn
-      self.validation_conn
-      self.test_conn
-    except:
-      self._load_data()
-        
-    if self.mode == "training":
-      c = self.training_conn.cursor()
-    elif self.mode == "validation":
-      c = self.validation_conn.cursor()
-    elif self.mode == "test":
-      c = self.test_conn.cursor()
-    else:
-      raise ValueError("The only allowed data_types are: 'training','validation' and 'test'.")
-    
-    # Fraction of the samples to be random
-    nrand = int(np.ceil(3*self.batch_size/4))
-    
-    # Fetch samples from db
-    samples_rand = self._fetch_n_records(nrand, offset=index*self.batch_size)
-    samples_nonull = self._fetch_n_records_nonull(self.batch_size-nrand, offset=0)
-
-    # Store batch 
-    X_batch=[]
-    y_batch=[]
-
-    # Process the fetched samples
-    for sample in samples_rand:
-      X, y = self._convert_sample(sample)
-      X_batch.append(X)
-      y_batch.append(y)
-    
-    for sample in samples_nonull:
-      X, y = self._convert_sample(sample)
-      X_batch.append(X)
-      y_batch.append(y)
-    
-    print_t("Batch generated in {}ms".format(np.ceil(1000*(time.time()-start))))
-    return (np.array(X_batch), np.array(y_batch))
+# The batches are generated by SQLBatchGenerators.SimpleBatchGenerator (see the
+# imports), which samples the rows by rowid in a random order per epoch, keeps
+# an index of the rows with a non-trivial parity and opens its database
+# connections once per process.
 
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
     END OF BATCH GENERATOR CODE
@@ -1248,9 +1017,10 @@ class SimpleBatchGenerator(keras.utils.Sequence):
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 #from matplotlib import pyplot as plt
 class test_callback(Callback):
-  def __init__(self):
-    self.X = bgv.__getitem__(0)[0]
-    self.y = bgv.__getitem__(0)[1]
+  def __init__(self, bgv):
+    # bgv is a CachedBatchGenerator, such that the same samples are evaluated
+    # after every epoch and only fetched once
+    self.X, self.y = bgv[0]
   
   def on_train_begin(self, logs={}):
     return
@@ -1376,10 +1146,21 @@ def fit_model(file_train,
               early_stop_min_delta=1e-4,
               n_epochs=conf_epochs,
               n_workers=4,
-              baseline=False):
+              baseline=False,
+              use_processes=False,
+              queue_size=10,
+              shuffle_seed=0):
     
-    bgt=SimpleBatchGenerator(file_train, file_val, file_test, batch_size=batch_size, mode='training')
-    bgv=SimpleBatchGenerator(file_train, file_val, file_test, batch_size=batch_size, mode='validation')
+    # The batches are prefetched by n_workers reader threads (or processes with
+    # use_processes=True), see PrefetchLoader. Keras itself runs in the main
+    # thread (workers=0) and only takes the ready batches from the queue.
+
+    # The batches only depend on shuffle_seed and the epoch, hence the cached
+    # validation batches (see CachedBatchGenerator) are the same in every run.
+    bgt=SimpleBatchGenerator(file_train, file_val, file_test, batch_size=batch_size, mode='training',
+                             shuffle_seed=shuffle_seed)
+    bgv=SimpleBatchGenerator(file_train, file_val, file_test, batch_size=batch_size, mode='validation',
+                             shuffle_seed=shuffle_seed)
 
     kd=SimpleDecoder(xshape=(cycle_length, 8), hidden_size=64) if not baseline else BaselineDecoder(xshape=(cycle_length, 8))
     
@@ -1389,7 +1170,7 @@ def fit_model(file_train,
     callbacks = []
 
     if conf_generate_ROC_curves==True:
-        callbacks.append(test_callback())
+        callbacks.append(test_callback(CachedBatchGenerator(bgv, n_batches=1)))
 
     # Append an early stopping layer
     if early_stop==True:
@@ -1400,12 +1181,27 @@ def fit_model(file_train,
                                                             mode='max')
         callbacks.append(early_stop_callback)
 
-    hist=model.fit_generator(generator=bgt,
-                        epochs=n_epochs,
-                        validation_data=bgv,
-                        use_multiprocessing=True,
-                        callbacks=callbacks,
-                        workers=n_workers);
+    train_loader=PrefetchLoader(bgt, n_workers=n_workers, queue_size=queue_size,
+                                use_processes=use_processes)
+    val_loader=PrefetchLoader(bgv, n_workers=n_workers, queue_size=queue_size,
+                              use_processes=use_processes)
+
+    try:
+        hist=model.fit_generator(generator=train_loader,
+                            steps_per_epoch=len(train_loader),
+                            epochs=n_epochs,
+                            validation_data=val_loader,
+                            validation_steps=len(val_loader),
+                            callbacks=callbacks,
+                            workers=0);
+    finally:
+        train_loader.close()
+        val_loader.close()
+    
+    stats=train_loader.stats()
+    print_t("Training waited for {0} of {1} batches, {2}s in total ({3}% of the time).".format(
+        stats['starved_batches'], stats['batches'], round(stats['wait_time'], 1),
+        round(100 * stats['starved_fraction'], 1)))
     
     return model, hist, (bgt, bgv)
 
@@ -1,5 +1,6 @@
 from QEC_full import print_t
 from QEC_full import fit_model
+from CachedBatchGenerators import CachedBatchGenerator
 from sklearn.metrics import roc_curve, auc
 import pandas as pd
 import numpy as np
@@ -21,7 +22,7 @@ def make_test(cycles, file_base, db_path):
                                early_stop_min_delta=1e-7, 
                                cycle_length=cycles,
                                n_epochs=50,
-                               n_workers=96,
+                               n_workers=4,
                                baseline=fit_baseline)
 
     datafile_prefix = 'baseline' if fit_baseline==True else 'simpledec'
@@ -30,12 +31,10 @@ def make_test(cycles, file_base, db_path):
     dfhist = pd.DataFrame(history.history)
     dfhist.to_csv(datafile_prefix + '_' + file_base + '_c' + str(cycles) + "_history_" + time.strftime("%Y-%m-%d-%H-%M-%S") + ".csv")
 
-    # Calculate roc_auc and save fpr, tpr as a DataFrame
-    Xs = [bgv.__getitem__(k)[0] for k in range(min(len(bgv), int(np.ceil(4000/bgv.batch_size))))]
-    ys = [bgv.__getitem__(k)[1] for k in range(min(len(bgv), int(np.ceil(4000/bgv.batch_size))))]
-    
-    Xs = np.vstack(Xs)
-    ys = np.vstack(ys)
+    # Calculate roc_auc and save fpr, tpr as a DataFrame. X and y are taken
+    # from the same (cached) batches.
+    bgc = CachedBatchGenerator(bgv, n_batches=int(np.ceil(4000/bgv.batch_size)))
+    Xs, ys = bgc.get_data()
     
     y_pred = model.predict(Xs)
     fpr, tpr, thr = roc_curve(ys[:,0], y_pred[:,0])
@@ -1,9 +1,13 @@
 import copy
+import os
 import sqlite3
+import threading
 import numpy as np
 import scipy.optimize as optim
 
 import keras
+
+from QECDataGenerator import read_storage_format, decode_int
 """
 keras.utils.Sequence is the base object for fitting to a sequence of data, such as a dataset.
 Every Sequence must implement the __getitem__ and the __len__ methods. 
@@ -11,14 +15,59 @@ If you want to modify your dataset between epochs you may implement on_epoch_end
 The method __getitem__ should return a complete batch.
 """
 
+def length_buckets(lengths, n_buckets=8):
+  """ Returns the upper bounds of n_buckets buckets of the sequence lengths, such
+  that every bucket contains about the same number of samples.
+
+  Input
+  -----
+
+  lengths - the number of cycles of every sample
+  n_buckets - the (maximal) number of buckets
+  """
+  lengths = np.sort(lengths)
+  quantiles = (np.arange(1, n_buckets + 1) * len(lengths)) // n_buckets - 1
+  return np.unique(lengths[quantiles])
+
+def make_bucketed_batches(keys, lengths, batch_size, bounds, rng):
+  """ Splits the keys into batches of samples with similar lengths. The samples
+  are sorted into the buckets with upper bounds bounds, shuffled within every
+  bucket and cut into batches. The order of the batches is shuffled as well.
+
+  Input
+  -----
+
+  keys - the keys of the samples
+  lengths - the number of cycles of every sample in keys
+  batch_size - the number of samples per batch, the last batch of every bucket
+               may be smaller
+  bounds - the (sorted) upper bounds of the buckets, see length_buckets
+  rng - numpy.random.RandomState used for shuffling
+  """
+  bucket = np.searchsorted(bounds, lengths)
+  batches = []
+  for b in np.unique(bucket):
+    bucket_keys = rng.permutation(keys[bucket == b])
+    batches += [bucket_keys[i:i + batch_size] for i in range(0, len(bucket_keys), batch_size)]
+  return [batches[i] for i in rng.permutation(len(batches))]
+
 """ 
 The following is a simple batch generator, that generates only the syndromes (without final syndromes)
-and the measured parity 
+and the measured parity.
+
+With bucketing=True the rows are grouped by their number of cycles (the length
+column) into n_buckets buckets, and every batch is taken from a single bucket,
+see make_bucketed_batches. The events are cut to the longest row of the batch,
+such that the time per epoch scales with the actual number of cycles. The
+number of time steps then varies between batches, which requires a model with
+the input shape (None, dim_syndr), see keras_decoders.SimpleDecoder.
 """
 class SimpleBatchGenerator(keras.utils.Sequence):
-  def __init__(self, training_fname, validation_fname, test_fname, batch_size=16, mode='training'):
+  def __init__(self, training_fname, validation_fname, test_fname, batch_size=16, mode='training',
+               shuffle_seed=0, bucketing=False, n_buckets=8):
     
-    self.dim_syndr = 8
+    # the number of syndromes per cycle is read from the data set, see _load_data
+    self.dim_syndr = None
     self.n_steps_net2 = 4
     
     self.training_fname=training_fname
@@ -31,32 +80,125 @@ class SimpleBatchGenerator(keras.utils.Sequence):
       raise ValueError("mode must be either 'training', 'validation' or 'test'")
       
     self.mode=mode
+    
+    # The rows are visited in a random order, which is reshuffled after every
+    # epoch. The order only depends on shuffle_seed and the epoch, such that
+    # all worker processes of keras agree on it.
+    self.shuffle_seed=shuffle_seed
+    self.epoch=0
+    
+    self.bucketing=bucketing
+    self.n_buckets=n_buckets
+    
+    # the index of the rows, loaded by the first call of _connect
+    self.rowids=None
+    
+    # the open connections of every thread, the random orders of the last
+    # epochs and the lock that guards the index and the orders, see __copy__
+    self.conns=threading.local()
+    self.orders={}
+    self.lock=threading.Lock()
+    return
+  
+  def _connect(self):
+    """ Opens the databases once per thread and process. The connections are
+    cached and reused by all batches. Connections must neither be shared across
+    threads nor across processes, therefore every reader thread and every
+    process that was forked (keras with use_multiprocessing=True) opens its own
+    connections.
+    
+    The keys and the index of the rows (rowids, rowids_nonull, lengths) are
+    only loaded by the first call. They are kept when the generator is copied,
+    forked or pickled (see PrefetchLoader), such that the other threads and
+    processes do not scan the data set again. """
+    if getattr(self.conns, 'pid', None) != os.getpid():
+      with self.lock:
+        if self.rowids is None:
+          self._load_data()
+        else:
+          self._open_databases()
+      self.conns.pid = os.getpid()
+    return
+  
+  def __copy__(self):
+    # A copy for another thread (see PrefetchLoader) shares the index, the
+    # random orders and the lock with the original. Only the connections are
+    # per thread, since they are kept in the thread-local conns.
+    sequence = self.__class__.__new__(self.__class__)
+    sequence.__dict__.update(self.__dict__)
+    return sequence
+  
+  def __getstate__(self):
+    # connections and locks can not be pickled, they are recreated after
+    # unpickling. The random orders are recomputed from the rowids by _shuffle.
+    state = self.__dict__.copy()
+    for key in ['conns', 'orders', 'lock']:
+      state.pop(key, None)
+    return state
+  
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.conns = threading.local()
+    self.orders = {}
+    self.lock = threading.Lock()
+    return
+  
+  def _open_databases(self):
+    # Once the index is loaded, only the database of the selected data set is
+    # read. The other data sets are only needed for the checks in _load_data.
+    fname = {'training': self.training_fname, 'validation': self.validation_fname,
+             'test': self.test_fname}[self.mode]
+    setattr(self.conns, self.mode + '_conn', sqlite3.connect(fname))
     return
   
   def _load_data(self):
     # Establish connections
-    self.training_conn = sqlite3.connect(self.training_fname)
-    self.validation_conn = sqlite3.connect(self.validation_fname)
-    self.test_conn = sqlite3.connect(self.test_fname)
+    self.conns.training_conn = sqlite3.connect(self.training_fname)
+    self.conns.validation_conn = sqlite3.connect(self.validation_fname)
+    self.conns.test_conn = sqlite3.connect(self.test_fname)
     
-    training_c = self.training_conn.cursor()
-    validation_c = self.validation_conn.cursor()
-    test_c = self.test_conn.cursor()
+    training_c = self.conns.training_conn.cursor()
+    validation_c = self.conns.validation_conn.cursor()
+    test_c = self.conns.test_conn.cursor()
     
     # get all the seeds
     training_c.execute('SELECT seed FROM data')
     validation_c.execute('SELECT seed FROM data')
     test_c.execute('SELECT seed FROM data')
         
-    self.training_keys = list(sorted([s[0] for s in training_c.fetchall()]))
-    self.validation_keys = list(sorted([s[0] for s in validation_c.fetchall()]))
-    self.test_keys = list(sorted([s[0] for s in test_c.fetchall()]))
+    # the seeds are only needed for the checks below, and are not kept
+    training_keys = list(sorted([s[0] for s in training_c.fetchall()]))
+    validation_keys = list(sorted([s[0] for s in validation_c.fetchall()]))
+    test_keys = list(sorted([s[0] for s in test_c.fetchall()]))
+    
+    # get the rowids of the selected data set, the batches are fetched by rowid.
+    # The rowids of the samples with a non-trivial parity are kept separately
+    # for oversampling them. The parity is stored as a np.bool_ (a 1 byte blob).
+    c = {'training': training_c, 'validation': validation_c, 'test': test_c}[self.mode]
+    
+    # the storage format of the selected data set, see QECDataGenerator.generate
+    self.storage_format = read_storage_format(c)
+    if self.storage_format['storage_version'] == 2:
+      self.dim_syndr = self.storage_format['events_shape'][-1]
+    else:
+      # the events contain all d**2 - 1 ancillas
+      c.execute('SELECT distance FROM info')
+      self.dim_syndr = int(c.fetchone()[0])**2 - 1
+    
+    # The length is stored as a np.array([length]) (an int64 blob).
+    c.execute('SELECT rowid, parity, length FROM data ORDER BY rowid')
+    rows = c.fetchall()
+    self.rowids = np.array([r[0] for r in rows], dtype=np.int64)
+    self.rowids_nonull = np.array([r[0] for r in rows if r[1] in (1, b'\x01')], dtype=np.int64)
+    self.lengths = np.array([decode_int(r[2]) for r in rows], dtype=np.int64)
+    if self.bucketing:
+      self.bounds = length_buckets(self.lengths, self.n_buckets)
 
     # checks that there is no overlapp in the seeds of the data sets
-    self.N_training = len(self.training_keys)
-    self.N_validation = len(self.validation_keys)
-    self.N_test = len(self.test_keys)
-    all_keys = set(self.training_keys + self.validation_keys + self.test_keys)
+    self.N_training = len(training_keys)
+    self.N_validation = len(validation_keys)
+    self.N_test = len(test_keys)
+    all_keys = set(training_keys + validation_keys + test_keys)
         
     if len(all_keys) < self.N_training + self.N_validation + self.N_test:
       raise ValueError("There is overlap between the seeds of the training,  validation, and test sets. This"
@@ -69,76 +211,83 @@ class SimpleBatchGenerator(keras.utils.Sequence):
 
   def _close_databases(self):
     """ This function closes all databases """
-    self.training_conn.close()
-    self.validation_conn.close()
-    self.test_conn.close()
+    for key in ['training_conn', 'validation_conn', 'test_conn']:
+      if hasattr(self.conns, key):
+        getattr(self.conns, key).close()
+        delattr(self.conns, key)
+    self.conns.pid = None
     return
 
-  def _fetch_n_records(self, n, offset=0):
-    # select data from the corresponding database
+  def _get_cursor(self):
+    # select the database of the corresponding data set. Every query goes
+    # through here, such that a forked process never uses the connections of
+    # its parent.
+    self._connect()
     if self.mode == "training":
-      c = self.training_conn.cursor()
+      return self.conns.training_conn.cursor()
     elif self.mode == "validation":
-      c = self.validation_conn.cursor()
+      return self.conns.validation_conn.cursor()
     elif self.mode == "test":
-      c = self.test_conn.cursor()
+      return self.conns.test_conn.cursor()
     else:
       raise ValueError("The only allowed data_types are: 'training','validation' and 'test'.")
-    
-    query="SELECT events, err_signal, parity, length FROM data ORDER BY RANDOM() LIMIT " + str(n)
-    if offset != 0:
-      query=query+" OFFSET " + str(offset)
 
-    c.execute(query)
-    # c.execute("SELECT events, err_signal, parity, length FROM data ORDER BY RANDOM() LIMIT ?", (1, ))
-    sample = c.fetchmany(n)
-    
-    return sample
+  def _shuffle(self, epoch):
+    # random order of the rows in the given epoch
+    rng = np.random.RandomState([self.shuffle_seed, epoch])
+    if self.bucketing:
+      return {'batches': make_bucketed_batches(self.rowids, self.lengths, self.batch_size,
+                                               self.bounds, rng)}
+    return {'order': rng.permutation(self.rowids),
+            'order_nonull': rng.permutation(self.rowids_nonull)}
+
+  def _get_orders(self):
+    """ Returns the random order of the current epoch (see _shuffle). Every
+    order is computed once and shared by all copies of the generator, such that
+    the reader threads of a PrefetchLoader do not shuffle the index each. The
+    orders of the last two epochs are kept, since the readers of the next epoch
+    start before the batches of the current epoch are consumed. """
+    with self.lock:
+      if self.epoch not in self.orders:
+        self.orders[self.epoch] = self._shuffle(self.epoch)
+        while len(self.orders) > 2:
+          del self.orders[next(iter(self.orders))]
+      return self.orders[self.epoch]
+
+  def _fetch_bucketed_batch(self, index):
+    # fetch the records of batch number index of the bucketed batches of this epoch
+    batches = self._get_orders()['batches']
+    return self._fetch_by_keys(batches[index % len(batches)])
+
+  def _fetch_by_keys(self, keys):
+    """ fetches the records with the given rowids, using the rowid index.
+    The keys are split into pieces to stay below the limit of SQL variables. """
+    c = self._get_cursor()
+    samples = []
+    for k in range(0, len(keys), 500):
+      piece = [int(key) for key in keys[k:k + 500]]
+      c.execute("SELECT events, err_signal, parity, length FROM data WHERE rowid IN (" +
+                ",".join("?" * len(piece)) + ")", piece)
+      samples += c.fetchall()
+    return samples
+
+  def _fetch_n_records(self, n, offset=0):
+    # fetch the n records at position offset of the random order of this epoch
+    keys = np.take(self._get_orders()['order'], np.arange(offset, offset + n), mode='wrap')
+    return self._fetch_by_keys(keys)
   
   # fetch n records where the final parity is not null
   def _fetch_n_records_nonull(self, n, offset=0):
-    
-    try:
-      self.tarining_conn
-      self.validation_conn
-      self.test_conn
-    except:
-      self._load_data()
-    
-    if self.mode == "training":
-      c = self.training_conn.cursor()
-    elif self.mode == "validation":
-      c = self.validation_conn.cursor()
-    elif self.mode == "test":
-      c = self.test_conn.cursor()
-    else:
-      raise ValueError("The only allowed data_types are: 'training','validation' and 'test'.")
-    
-    query="SELECT events, err_signal, parity, length FROM data WHERE hex(parity)='01' ORDER BY RANDOM() LIMIT " + str(n)
-    if offset != 0:
-      query=query+" OFFSET " + str(offset)
-    
-    c.execute(query)
-    samples=c.fetchmany(n)
-    return samples
+    order_nonull = self._get_orders()['order_nonull']
+    if len(order_nonull) == 0:
+      return []
+    keys = np.take(order_nonull, np.arange(offset, offset + n), mode='wrap')
+    return self._fetch_by_keys(keys)
 
   def _fetch_one_batch(self):
-    # select data from the corresponding database
-    if self.mode == "training":
-      c = self.training_conn.cursor()
-    elif self.mode == "validation":
-      c = self.validation_conn.cursor()
-    elif self.mode == "test":
-      c = self.test_conn.cursor()
-    else:
-      raise ValueError("The only allowed data_types are: 'training','validation' and 'test'.")
-    
-    query="SELECT events, err_signal, parity, length FROM data ORDER BY RANDOM() LIMIT " + str(self.batch_size)
-    c.execute(query)
-    # c.execute("SELECT events, err_signal, parity, length FROM data ORDER BY RANDOM() LIMIT ?", (self.batch_size, ))
-    samples = c.fetchmany(self.batch_size)
-    
-    return samples
+    # fetch batch_size random records
+    keys = np.random.choice(self.rowids, size=min(self.batch_size, len(self.rowids)), replace=False)
+    return self._fetch_by_keys(keys)
   
   def _convert_sample(self, sample):
     """ formats a single batch of data
@@ -165,13 +314,42 @@ class SimpleBatchGenerator(keras.utils.Sequence):
     # fsyndr = np.fromstring(fsyndr, dtype=bool)
     # parity = np.frombuffer(parity, dtype=bool)
     
-    syndr = np.fromstring(syndr, dtype=bool).reshape([n_steps, -1])
+    if self.storage_format['storage_version'] == 2:
+      shape = self.storage_format['events_shape']
+      syndr = np.unpackbits(np.frombuffer(syndr, dtype=np.uint8),
+                            count=int(np.prod(shape))).astype(bool).reshape(shape)
+    else:
+      syndr = np.frombuffer(syndr, dtype=bool).reshape([n_steps, -1])
     parity = np.frombuffer(parity, dtype=bool)
     
     return syndr, parity
 
+  def _convert_batch(self, samples):
+    """ formats a list of samples into a batch (X, y). Since all events in a
+    data set have the same size, the whole batch is decoded in one call. With
+    bucketing, the events are cut to the longest sample of the batch.
+    
+    Input
+    -----
+    
+    samples - raw data from the database
+    """
+    n = len(samples)
+    events = np.frombuffer(b''.join([sample[0] for sample in samples]), dtype=np.uint8).reshape([n, -1])
+    
+    if self.storage_format['storage_version'] == 2:
+      shape = self.storage_format['events_shape']
+      X = np.unpackbits(events, axis=1, count=int(np.prod(shape))).astype(bool).reshape((n, ) + shape)
+    else:
+      X = events.astype(bool).reshape([n, -1, self.dim_syndr])
+    if self.bucketing:
+      X = X[:, :max(decode_int(sample[3]) for sample in samples)]
+    y = np.frombuffer(b''.join([sample[2] for sample in samples]), dtype=bool).reshape([n, 1])
+    
+    return X, y
+
   def get_n_batches(self, n_batches):
-    self._load_data()
+    self._connect()
     batches=[]
     for k in range(n_batches):
       fetched_samples=self._fetch_one_batch()
@@ -195,12 +373,10 @@ class SimpleBatchGenerator(keras.utils.Sequence):
   """
   # A keras.utils.Sequence object must impement __len__ function
   def __len__(self):
-    try:
-      self.N_training
-      self.N_validation
-      self.N_test
-    except:
-      self._load_data()
+    self._connect()
+    
+    if self.bucketing:
+      return len(self._get_orders()['batches'])
     
     if self.mode == "training":
       return int(np.ceil(self.N_training/float(self.batch_size)))
@@ -213,45 +389,24 @@ class SimpleBatchGenerator(keras.utils.Sequence):
   # A keras.utils.Sequence object must impement __getitem__ function
   def __getitem__(self, index):
     
-    try:
-      self.tarining_conn
-      self.validation_conn
-      self.test_conn
-    except:
-      self._load_data()
-        
-    if self.mode == "training":
-      c = self.training_conn.cursor()
-    elif self.mode == "validation":
-      c = self.validation_conn.cursor()
-    elif self.mode == "test":
-      c = self.test_conn.cursor()
-    else:
-      raise ValueError("The only allowed data_types are: 'training','validation' and 'test'.")
+    self._connect()
+    
+    if self.bucketing:
+      return self._convert_batch(self._fetch_bucketed_batch(index))
     
     # Fraction of the samples to be random
     nrand = int(np.ceil(3*self.batch_size/4))
     
     # Fetch samples from db
-    samples_rand = self._fetch_n_records(nrand, offset=index*self.batch_size)
-    samples_nonull = self._fetch_n_records_nonull(self.batch_size-nrand, offset=0)
-
-    # Store batch 
-    X_batch=[]
-    y_batch=[]
+    samples_rand = self._fetch_n_records(nrand, offset=index*nrand)
+    samples_nonull = self._fetch_n_records_nonull(self.batch_size-nrand, offset=index*(self.batch_size-nrand))
 
     # Process the fetched samples
-    for sample in samples_rand:
-      X, y = self._convert_sample(sample)
-      X_batch.append(X)
-      y_batch.append(y)
-    
-    for sample in samples_nonull:
-      X, y = self._convert_sample(sample)
-      X_batch.append(X)
-      y_batch.append(y)
-      
-    return (np.array(X_batch), np.array(y_batch))
+    return self._convert_batch(samples_rand + samples_nonull)
+
+  # A keras.utils.Sequence object may implement on_epoch_end, here we reshuffle
+  def on_epoch_end(self):
+    self.epoch += 1
 
 
 
@@ -0,0 +1,149 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import keras
+
+from QECDataGenerator import _simulate_shard
+"""
+A batch generator that simulates the runs of every batch on the fly with the
+vectorized SurfaceCode.make_runs, instead of reading them from a database
+written by QECDataGenerator. The samples are the same as the ones of
+QECDataGenerator.generate for training and validation data (mode 0 and 1).
+"""
+
+class SimulationBatchGenerator(keras.utils.Sequence):
+  """ Returns the events and the final parity of batches of simulated runs.
+  Batch k consists of the seeds N0 + k*batch_size, N0 + k*batch_size + 1, ...,
+  such that the batches do not overlap and are reproducible. The number of
+  error cycles iterates between n_steps_min and n_steps_max, and the events are
+  padded to n_steps_max, as in QECDataGenerator.convert_simple.
+
+  With n_workers > 0 the batches are simulated by a pool of processes, and the
+  next n_prefetch batches of the epoch are simulated while the current batch
+  is used (double buffering for n_prefetch = 1).
+
+  Input
+  -----
+
+  surf_params - keyword arguments of SurfaceCode (without the seed)
+  N0 - the first seed, the seed ranges of training, validation and test data
+       must not overlap (QECDataGenerator uses N0 = mode * 10**8)
+  seed_range - the seeds are taken from N0, ..., N0 + seed_range - 1. With
+               fresh_seeds, the epochs start again at N0 once the next epoch
+               would leave this range, such that the seeds never reach the
+               next data set.
+  N_samples - the number of samples per epoch
+  n_steps_min, n_steps_max - range of the number of error cycles
+  batch_size - the number of samples per batch
+  sampling - the way the errors are sampled, see SurfaceCode.make_runs
+  fresh_seeds - if True, every epoch uses the next N_samples seeds instead of
+                the same samples
+  shuffle_seed - seed of the random order of the batches in every epoch
+  n_workers - the number of worker processes, 0 simulates in the calling process
+  n_prefetch - the number of batches that are simulated ahead
+  """
+  def __init__(self, surf_params, N0, N_samples, n_steps_min, n_steps_max, batch_size=16,
+               sampling='dense', fresh_seeds=False, shuffle_seed=0, n_workers=0, n_prefetch=2,
+               seed_range=10**8):
+    if N_samples > seed_range:
+      raise ValueError("N_samples=" + str(N_samples) + " does not fit into the seed range of "
+                       + str(seed_range) + " seeds")
+    self.surf_params=surf_params
+    self.N0=N0
+    self.N_samples=N_samples
+    self.seed_range=seed_range
+    self.n_steps_min=n_steps_min
+    self.n_steps_max=n_steps_max
+    self.batch_size=batch_size
+    self.sampling=sampling
+    self.fresh_seeds=fresh_seeds
+    self.shuffle_seed=shuffle_seed
+    self.n_workers=n_workers
+    self.n_prefetch=n_prefetch
+    self.epoch=0
+
+    self.n_batches = int(np.ceil(N_samples/float(batch_size)))
+
+    # process id of the process that owns the worker pool, see _get_pool
+    self.pool_pid=None
+    return
+
+  def __getstate__(self):
+    # the worker pool can not be pickled, it is restarted after unpickling
+    state = self.__dict__.copy()
+    for key in ['pool', 'pending']:
+      state.pop(key, None)
+    state['pool_pid'] = None
+    return state
+
+  def _get_pool(self):
+    # starts the worker pool, once per process
+    if self.pool_pid != os.getpid():
+      self.pool = ProcessPoolExecutor(max_workers=self.n_workers)
+      self.pending = {}
+      self.pool_pid = os.getpid()
+    return self.pool
+
+  def _get_order(self, epoch):
+    # random order of the batches in the given epoch
+    return np.random.RandomState([self.shuffle_seed, epoch]).permutation(self.n_batches)
+
+  def _shard(self, epoch, batch):
+    # the arguments of _simulate_shard for batch number batch of the given epoch
+    first_index = batch * self.batch_size
+    if self.fresh_seeds:
+      # the number of epochs with fresh seeds that fit into the seed range
+      n_fresh = self.seed_range // self.N_samples
+      first_index += (epoch % n_fresh) * self.N_samples
+    last_index = min(first_index + self.batch_size, (first_index // self.N_samples + 1) * self.N_samples)
+    seeds = list(range(self.N0 + first_index, self.N0 + last_index))
+    return (self.surf_params, seeds, self.n_steps_min, self.n_steps_max, first_index, 0, 1, True,
+            self.sampling)
+
+  def _submit(self, epoch, index):
+    # simulates batch number index of the given epoch in the worker pool
+    if (epoch, index) not in self.pending and index < self.n_batches:
+      batch = self._get_order(epoch)[index]
+      self.pending[(epoch, index)] = self.pool.submit(_simulate_shard, *self._shard(epoch, batch))
+
+  def get_batch(self, rows):
+    """ Returns the batch (X, y) of the rows of QECDataGenerator.convert_simple. """
+    n = len(rows)
+    X = np.stack([row[1] for row in rows])
+    y = np.array([row[3] for row in rows], dtype=bool).reshape([n, 1])
+    return X, y
+
+  def close(self):
+    """ Shuts the worker pool down. """
+    if self.pool_pid == os.getpid():
+      self.pool.shutdown(wait=False)
+      self.pool_pid = None
+    return
+
+  """
+  Functions to be implemented according to keras.utils.Sequence.
+  """
+  def __len__(self):
+    return self.n_batches
+
+  def __getitem__(self, index):
+    if self.n_workers == 0:
+      batch = self._get_order(self.epoch)[index]
+      return self.get_batch(_simulate_shard(*self._shard(self.epoch, batch)))
+
+    self._get_pool()
+    self._submit(self.epoch, index)
+    future = self.pending.pop((self.epoch, index))
+    for k in range(index + 1, index + 1 + self.n_prefetch):
+      self._submit(self.epoch, k)
+    return self.get_batch(future.result())
+
+  def on_epoch_end(self):
+    self.epoch += 1
+    if self.pool_pid == os.getpid():
+      # batches of the previous epoch that were prefetched, but not used
+      for key in [key for key in self.pending if key[0] < self.epoch]:
+        self.pending.pop(key).cancel()
+      for k in range(self.n_prefetch):
+        self._submit(self.epoch, k)
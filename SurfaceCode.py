@@ -22,6 +22,18 @@ class SurfaceCode:
       pm -- measurement errors applied at both ancilla and data qubit readouts
       """
 
+    # Compiled layouts per distance, and the attributes they consist of
+
+    _layouts = {}
+    _layout_attrs = [
+        'data_l', 'x_anc_l', 'z_anc_l', 'anc_l', 'x_indcs', 'z_indcs',
+        'x_north_dict', 'x_east_dict', 'x_south_dict', 'x_west_dict',
+        'z_north_dict', 'z_east_dict', 'z_south_dict', 'z_west_dict',
+        'z_anc_data_conn', 'had_indcs', 'cnot_indcs', 'z_conn_indcs',
+        'anc_flat_indcs', 'had_flat_indcs', 'cnot_flat_indcs', 'z_anc_mask',
+        'z_check_matrix', 'anc_pos', 'z_anc_pos', 'meas_err_pos',
+        ]
+
     def __init__(
         self,
         seed,
@@ -54,13 +66,20 @@ class SurfaceCode:
         (self.pax, self.pay, self.paz) = (pax, pay, paz)
         self.pm = pm
 
-        # # # Initialize data and ancilla qubits # # #
-
-        self._init_qubits()
+        # # # Initialize data and ancilla qubits, CNOT gates and circuit # # #
 
-        # # # Initialize CNOT gates # # #
+        # The layout only depends on the distance. It is built and compiled
+        # once per distance and shared (read-only) by all instances.
 
-        self._init_cnots()
+        if self.dist in SurfaceCode._layouts:
+            self.__dict__.update(SurfaceCode._layouts[self.dist])
+            self._reinitialize(self.seed)
+        else:
+            self._init_qubits()
+            self._init_cnots()
+            self._compile_circuit()
+            SurfaceCode._layouts[self.dist] = dict((key,
+                    self.__dict__[key]) for key in self._layout_attrs)
 
     def _init_qubits(self):
         """ This function initializes both ancilla and data qubits. It also
@@ -144,18 +163,86 @@ class SurfaceCode:
         for qb in self.z_west_dict.keys():
             self.z_anc_data_conn[qb].append(self.z_west_dict[qb])
 
-    def _reinitialize(self, seed):
+    def _compile_circuit(self):
+        """ This function compiles the circuit into flat integer index arrays,
+        such that it can be replayed by fancy-indexed XORs without walking
+        the CNOT dictionaries. Indices refer to the condensed lists anc_l and
+        data_l, the flat versions to the flattened arrays anc_qubits and
+        data_qubits.
+
+        had_indcs -- ancillas that undergo a Hadamard rotation (x-ancillas)
+        cnot_indcs -- for each of the four CNOT steps a tuple
+                      ((x_anc, x_data), (z_anc, z_data)), where the x-ancillas
+                      are controls and the z-ancillas are targets
+        z_conn_indcs -- for each z-ancilla (in the order of the final
+                        stabilizers) the connected data qubits
+        z_anc_mask -- boolean (dist + 1) x (dist + 1) matrix, which is True
+                      at the positions of the z-ancillas
+        z_check_matrix -- parity-check matrix H of the z-stabilizers (in the
+                          order of the final stabilizers) x data qubits, the
+                          final stabilizers are H x mod 2
+        anc_pos, z_anc_pos -- index arrays of the positions of the condensed
+                              ancillas (anc_l) and of the sorted z-ancillas
+                              in the ancilla matrix
+        meas_err_pos -- index arrays of the positions of the ancillas in the
+                        order of their measurement errors
+        """
+
+        self.anc_flat_indcs = np.array([m * (self.dist + 1) + n for (m, n)
+                                       in self.anc_l], dtype=int)
+
+        self.had_indcs = np.array(self.x_indcs, dtype=int)
+        self.cnot_indcs = [(self._cnot_indices(x_dict),
+                            self._cnot_indices(z_dict))
+                           for (x_dict, z_dict) in [
+                               (self.x_north_dict, self.z_north_dict),
+                               (self.x_west_dict, self.z_east_dict),
+                               (self.x_east_dict, self.z_west_dict),
+                               (self.x_south_dict, self.z_south_dict)]]
+        self.z_conn_indcs = [np.array([m * self.dist + n for (m, n) in
+                             self.z_anc_data_conn[qb]], dtype=int)
+                             for qb in sorted(self.z_anc_l)]
+
+        self.z_anc_mask = np.zeros(shape=[self.dist + 1, self.dist + 1],
+                                   dtype=bool)
+        for qb in self.z_anc_l:
+            self.z_anc_mask[qb] = True
+
+        self.z_check_matrix = np.zeros(shape=[self.n_z_stab, self.n_data],
+                                       dtype=np.uint8)
+        for (k, conn) in enumerate(self.z_conn_indcs):
+            self.z_check_matrix[k, conn] = 1
+
+        self.anc_pos = tuple(np.array(self.anc_l, dtype=int).T)
+        self.z_anc_pos = tuple(np.array(sorted(self.z_anc_l), dtype=int).T)
+        self.meas_err_pos = tuple(np.array(self.x_anc_l + self.z_anc_l,
+                                  dtype=int).T)
+
+        self.had_flat_indcs = self.anc_flat_indcs[self.had_indcs]
+        self.cnot_flat_indcs = [((self.anc_flat_indcs[xa], xd),
+                                (self.anc_flat_indcs[za], zd))
+                                for ((xa, xd), (za, zd)) in self.cnot_indcs]
+
+    def _reinitialize(self, seed, sampling='dense'):
         """ This function reinitializes the qubits and sets a new seed.
 
         Input
         -----
         seed - a new seed for the random number generator
+        sampling - 'dense' for the legacy RandomState, 'philox' for the
+                   counter-based CounterRNG
         """
 
         # Reinitialize random number generator
 
         self.seed = seed
-        self.rng = np.random.RandomState(seed)
+        if sampling == 'dense':
+            self.rng = np.random.RandomState(seed)
+        elif sampling == 'philox':
+            self.rng = CounterRNG(seed, len(self._cycle_thresholds()))
+        else:
+            raise ValueError("sampling must be 'dense' or 'philox', but is "
+                             + str(sampling))
 
         # Reinitialize qubits
 
@@ -205,8 +292,7 @@ class SurfaceCode:
 
         # Apply uncorrelated errors to all qubits
 
-        self._apply_uncorr_errs(self.x_anc_l + self.z_anc_l, 'anc')
-        self._apply_uncorr_errs(self.data_l, 'data')
+        self._apply_uncorr_errs('all')
 
     def _do_step_2(self):
         """ This function executes the second step of the circuit model. During
@@ -214,7 +300,7 @@ class SurfaceCode:
         CNOT gates are applied to the z-ancillas.
         """
 
-        self._do_cnot_step(self.x_north_dict, self.z_north_dict)
+        self._do_cnot_step(0)
 
     def _do_step_3(self):
         """ This function executes the third step of the circuit model. During
@@ -222,7 +308,7 @@ class SurfaceCode:
         gates are applied to the z-ancillas.
         """
 
-        self._do_cnot_step(self.x_west_dict, self.z_east_dict)
+        self._do_cnot_step(1)
 
     def _do_step_4(self):
         """ This function executes the fourth step of the circuit model. During
@@ -230,7 +316,7 @@ class SurfaceCode:
         gates are applied to the z-ancillas.
         """
 
-        self._do_cnot_step(self.x_east_dict, self.z_west_dict)
+        self._do_cnot_step(2)
 
     def _do_step_5(self):
         """ This function executes the fifth step of the circuit model. During
@@ -238,7 +324,7 @@ class SurfaceCode:
         CNOT gates are applied to the z-ancillas.
         """
 
-        self._do_cnot_step(self.x_south_dict, self.z_south_dict)
+        self._do_cnot_step(3)
 
     def _do_step_6(self):
         """ This function executes the sixth step of the circuit model. It is the
@@ -262,11 +348,9 @@ class SurfaceCode:
 
         stabs = copy.copy(self.anc_qubits[:, :, 0])
 
-        # Apply measurement errors
+        # Apply measurement errors (one random number per ancilla)
 
-        for qb in self.x_anc_l + self.z_anc_l:
-            if self.rng.rand() < self.pm:
-                stabs[qb] = not stabs[qb]
+        stabs[self.meas_err_pos] ^= self.rng.rand(self.n_anc) < self.pm
 
         # Reset the phase error information
 
@@ -274,7 +358,7 @@ class SurfaceCode:
 
         # The data qubits are idling and experience uncorrelated errors
 
-        self._apply_uncorr_errs(self.data_l, 'data')
+        self._apply_uncorr_errs('data')
 
         return stabs
 
@@ -288,9 +372,7 @@ class SurfaceCode:
         stabs_condensed -- measurement of the stabilizers in a condensed list
         """
 
-        stabs = self._do_measure_step()
-        stabs_condensed = np.array([stabs[qb] for qb in self.anc_l])
-        return stabs_condensed
+        return self._do_measure_step()[self.anc_pos]
 
     def _get_parity_of_bitflips(self):
         """ This function returns the parity of the number of x- and y-errors
@@ -301,13 +383,7 @@ class SurfaceCode:
         parity -- parity of the number of x- and y-errors on the data qubits
         """
 
-        n_xy_errs = 0
-        for row in self.data_qubits:
-            for el in row:
-                if el[0]:
-                    n_xy_errs += 1
-        parity = bool(np.mod(n_xy_errs, 2))
-        return parity
+        return self._get_parity(self.data_qubits[:, :, 0])
 
     def _calc_final_z_stabs(self):
         """ This function calculates the final z-stabilizers from the measured
@@ -322,29 +398,11 @@ class SurfaceCode:
         meas_parity -- parity of measurement errors
         """
 
-        # Measure data qubits (loose phase information)
-
-        data_qubits_meas = copy.copy(self.data_qubits[:, :, 0])
-
-        # Apply measurement errors
-
-        (d1, d2) = np.shape(data_qubits_meas)
-        m_errs = self.rng.rand(d1, d2) < self.pm
-        data_qubits_meas = np.bitwise_xor(data_qubits_meas, m_errs)
-        meas_parity = np.mod(sum(sum(m_errs)), 2)
-
-        # Calculate final stabilizers. The idea is to start with clean
-        # ancilla qubits and then flip them for each measured bitflip
-        # error on the neighboring data qubits.
-
+        (z_stabs_condensed, meas_parity) = \
+            self._calc_final_z_stabs_condensed()
         z_stabs = np.zeros(shape=[self.dist + 1, self.dist + 1],
                            dtype=bool)
-        for anc_qb in self.z_anc_data_conn.keys():
-            data_qb_l = self.z_anc_data_conn[anc_qb]
-            for data_qb in data_qb_l:
-                if data_qubits_meas[data_qb]:
-                    z_stabs[anc_qb] = not z_stabs[anc_qb]
-
+        z_stabs[self.z_anc_pos] = z_stabs_condensed
         return (z_stabs, meas_parity)
 
     def _calc_final_z_stabs_condensed(self):
@@ -358,151 +416,119 @@ class SurfaceCode:
         meas_parity -- parity of measurement errors
         """
 
-        (z_stabs, meas_parity) = self._calc_final_z_stabs()
-        z_stabs = np.array([z_stabs[qb] for qb in sorted(self.z_anc_l)])
+        # Measure data qubits (loose phase information)
+        # and apply measurement errors
+
+        m_errs = self.rng.rand(self.dist, self.dist) < self.pm
+        data_qubits_meas = self.data_qubits[:, :, 0] ^ m_errs
+        meas_parity = self._get_parity(m_errs)
+
+        # Calculate final stabilizers, each z-ancilla is flipped by the
+        # measured bitflips on the connected data qubits.
+
+        z_stabs = self._get_z_stabs(data_qubits_meas.reshape(-1))
         return (z_stabs, meas_parity)
 
-    def _do_cnot_step(self, x_dict, z_dict):
-        """ This function executes one of the CNOT steps. It applies the CNOT
-        operations for both ancilla and data qubits.
+    def _get_z_stabs(self, data_meas):
+        """ This function calculates the z-stabilizers of measured data
+        qubits with the parity-check matrix, H x mod 2.
 
         Input
         -----
-        x-dict -- a dictionary containing the connections set by the CNOT
-                  gates between x-ancillas and data qubits
-        z-dict -- like x-dict, but for z-ancillas """
-
-        # Apply CNOTS
+        data_meas -- boolean array of shape (..., n_data), the measured data
+                     qubits in the order of data_l
 
-        self._do_cnots(x_dict, 'x')
-        self._do_cnots(z_dict, 'z')
-
-        # Apply uncorrelated errors to all qubits
+        Output
+        ------
+        z_stabs -- boolean array of shape (..., n_z_stab), the z-stabilizers
+                   in the order of the sorted z-ancillas
+        """
 
-        self._apply_uncorr_errs(self.x_anc_l + self.z_anc_l, 'anc')
-        self._apply_uncorr_errs(self.data_l, 'data')
+        return (np.dot(data_meas.astype(np.uint8), self.z_check_matrix.T)
+                & 1).astype(bool)
 
-    def _apply_uncorr_errs(self, qubits, which_qubits):
-        """ This function applies uncorrelated errors to the qubits.
+    @staticmethod
+    def _get_parity(bits, axis=None):
+        """ This function returns the parity of the number of set bits
+        (a popcount), of all bits or along the given axis.
 
         Input
         -----
-        qubits -- a list with all the qubits that are subject to uncorrelated
-                  errors (must be either all data- or all ancilla-qubits)
-        which_qubits -- a string describing the type of qubits in 'qubits':
-                        'data' for data qubits, 'anc' for ancilla qubits
-        """
-
-        if which_qubits == 'data':
-            for qb in qubits:
-
-            # We throw the dice three times for independent x-, y- and z-errors
-
-                rnx = self.rng.rand()
-                rny = self.rng.rand()
-                rnz = self.rng.rand()
-                if rnx < self.pqx:
-                    self.data_qubits[qb][0] = \
-                        not self.data_qubits[qb][0]
-                if rny < self.pqy:
-                    self.data_qubits[qb][0] = \
-                        not self.data_qubits[qb][0]
-                    self.data_qubits[qb][1] = \
-                        not self.data_qubits[qb][1]
-                if rnz < self.pqz:
-                    self.data_qubits[qb][1] = \
-                        not self.data_qubits[qb][1]
-        elif which_qubits == 'anc':
-
-          # We throw the dice three times for independent x-, y- and z-errors
-
-            for qb in qubits:
-                rnx = self.rng.rand()
-                rny = self.rng.rand()
-                rnz = self.rng.rand()
-                if rnx < self.pax:
-                    self.anc_qubits[qb][0] = not self.anc_qubits[qb][0]
-                if rny < self.pay:
-                    self.anc_qubits[qb][0] = not self.anc_qubits[qb][0]
-                    self.anc_qubits[qb][1] = not self.anc_qubits[qb][1]
-                if rnz < self.paz:
-                    self.anc_qubits[qb][1] = not self.anc_qubits[qb][1]
-        else:
-
-            raise ValueError("which_qubits must be 'data' or 'anc' but is "
-                              + str(which_qubits))
+        bits -- boolean array
+        axis -- the axis to count along, None for all bits
 
-    def _hadamard_on_x_ancs(self):  # test written
-        """ This function applies a Hadamard gate to the x-ancillas. This gate
-        exchanges bitflip- and phaseflip-errors, i.e. x <--> z errors.
-        Y errors get a global phase that we can ignore.
+        Output
+        ------
+        parity -- True for an odd number of set bits
         """
 
-        for qb in self.x_anc_l:
-            (e1, e2) = self.anc_qubits[qb]
-            self.anc_qubits[qb] = [e2, e1]
+        return np.count_nonzero(bits, axis=axis) % 2 == 1
 
-    def _do_cnots(self, cnots, which_anc):
-        """ This function executes the CNOT gates.
-        For x-ancillas: ancilla qubits are control bits, data qubits are
-                        target bits
-        For z-ancillas: ancilla qubits are target bits, data qubits are
-                        control bits
+    def _do_cnot_step(self, layer):
+        """ This function executes one of the CNOT steps. It applies the CNOT
+        operations for both ancilla and data qubits, using the compiled
+        circuit (see _compile_circuit).
 
         Input
         -----
-        cnots -- a dictionary that describes how the cnots are connecting
-                 ancillas and data qubits
-        which_anc -- a string, saying whether the CNOTs connect to
-                     x- or z-ancillas
-        """
-
-        # Figure out what needs to be done
-
-        for anc_qb in cnots.keys():
-            data_qb = cnots[anc_qb]
-            anc_err = self.anc_qubits[anc_qb]
-            data_err = self.data_qubits[data_qb]
-            if which_anc == 'x':
-                (anc_err, data_err) = self._get_cnot_action(anc_err,
-                        data_err)
-            elif which_anc == 'z':
-                (data_err, anc_err) = self._get_cnot_action(data_err,
-                        anc_err)
-            else:
-                raise ValueError("which_anc must be 'x' or 'z', but is "
-                                  + str(which_anc))
+        layer -- the index of the CNOT step (0: North/North, 1: West/East,
+                 2: East/West, 3: South/South for x-/z-ancillas) """
 
-          # Write the results onto the qubits
+        # Apply CNOTS. The x-ancillas are controls, the z-ancillas targets.
+        # Within one step all CNOTs act on different qubits.
 
-            self.anc_qubits[anc_qb] = anc_err
-            self.data_qubits[data_qb] = data_err
+        anc = self.anc_qubits.reshape(-1, 2)
+        data = self.data_qubits.reshape(-1, 2)
+        ((xa, xd), (za, zd)) = self.cnot_flat_indcs[layer]
+        data[xd, 0] ^= anc[xa, 0]
+        anc[xa, 1] ^= data[xd, 1]
+        anc[za, 0] ^= data[zd, 0]
+        data[zd, 1] ^= anc[za, 1]
 
-    def _get_cnot_action(self, c, t):  # test written
-        """ This function describes the action of the CNOT gates.
+        # Apply uncorrelated errors to all qubits
 
-        Input
-        -----
-        c -- errors on control qubit
-        t -- errors on target qubit
+        self._apply_uncorr_errs('all')
 
-        Output
+    def _apply_uncorr_errs(self, which_qubits):
+        """ This function applies uncorrelated errors to the qubits. The random
+        numbers of all affected qubits are drawn at once, in the order of the
+        qubits (ancillas as x_anc_l + z_anc_l, then data qubits as data_l) and
+        three per qubit for independent x-, y- and z-errors.
+
+        Input
         -----
-        c -- errors on control qubit
-        t -- errors on target qubit
+        which_qubits -- a string describing the qubits that are subject to
+                        uncorrelated errors: 'all' for ancilla and data
+                        qubits, 'data' for the data qubits only
         """
 
-        # X- or y-error on control
+        if which_qubits == 'all':
+            rands = self.rng.rand(self.n_anc + self.n_data, 3)
+            anc_errs = rands[:self.n_anc] < [self.pax, self.pay, self.paz]
+            self.anc_qubits[self.meas_err_pos] ^= \
+                anc_errs[:, :2] ^ anc_errs[:, 1:]
+            rands = rands[self.n_anc:]
+        elif which_qubits == 'data':
+            rands = self.rng.rand(self.n_data, 3)
+        else:
+
+            raise ValueError("which_qubits must be 'all' or 'data' but is "
+                              + str(which_qubits))
 
-        if c[0]:
-            t[0] = not t[0]
+        # A y-error flips both the bitflip- and the phaseflip-error
 
-        # Y- or z-error on target
+        data_errs = rands < [self.pqx, self.pqy, self.pqz]
+        data = self.data_qubits.reshape(-1, 2)
+        data ^= data_errs[:, :2] ^ data_errs[:, 1:]
 
-        if t[1]:
-            c[1] = not c[1]
+    def _hadamard_on_x_ancs(self):  # test written
+        """ This function applies a Hadamard gate to the x-ancillas. This gate
+        exchanges bitflip- and phaseflip-errors, i.e. x <--> z errors.
+        Y errors get a global phase that we can ignore.
+        """
 
-        return (c, t)
+        anc = self.anc_qubits.reshape(-1, 2)
+        anc[self.had_flat_indcs] = anc[self.had_flat_indcs, ::-1]
 
     def _anc_exists(self, m, n):
         """ This function checks if an ancilla qubit exist or is a dummy """
@@ -525,6 +551,7 @@ class SurfaceCode:
         seed,
         n_steps,
         condensed=True,
+        sampling='dense',
         ):
         """ This function first reinitializes the system, and the calculates
         a ('measurement') n_step steps. Note that since we return a final
@@ -539,6 +566,9 @@ class SurfaceCode:
         condensed -- a flag determining if the output should be in condensed
                      lists or in arrays that resemble the geometry of the
                      surface code
+        sampling -- 'dense' draws the random numbers from a RandomState
+                    seeded with seed, 'philox' from the counter-based
+                    CounterRNG (see make_runs)
 
         Output
         ------
@@ -553,7 +583,7 @@ class SurfaceCode:
 
         # Reinitialize the system
 
-        self._reinitialize(seed)
+        self._reinitialize(seed, sampling)
 
         # Execute the seven substeps n_step times
 
@@ -593,48 +623,146 @@ class SurfaceCode:
             else:
                 syndromes.append(self._do_measure_step())
 
-        syndromes = np.array(syndromes)
-        fstabs = np.array(fstabs)
+        syndromes = np.array(syndromes, dtype=bool)
+        fstabs = np.array(fstabs, dtype=bool)
         parities = np.array(parities)
 
         # Finally, we calculate the first and second derivative (events)
         # of the syndromes and the final error signal.
 
-        first_deriv = []
-        for s in range(n_steps):
-            if s < 1:
-                first_deriv.append(syndromes[s])
-            else:
-                first_deriv.append(np.bitwise_xor(syndromes[s],
-                                   syndromes[s - 1]))
-        first_deriv = np.array(first_deriv, dtype=bool)
+        (events, err_signal) = self._calc_events(syndromes[np.newaxis],
+                fstabs[np.newaxis], condensed)
+        (events, err_signal) = (events[0], err_signal[0])
 
-        second_deriv = []
-        for s in range(n_steps):
-            if s < 2:
-                second_deriv.append(syndromes[s])
-            else:
-                second_deriv.append(np.bitwise_xor(syndromes[s],
-                                    syndromes[s - 2]))
-        events = np.array(second_deriv, dtype=bool)
+        return (
+            seed,
+            syndromes,
+            events,
+            fstabs,
+            err_signal,
+            parities,
+            )
 
-        err_signal = []
-        if condensed:
-            for s in range(n_steps):
-                err_signal.append(np.bitwise_xor(fstabs[s],
-                                  first_deriv[s][self.z_indcs]))
+    def _cnot_indices(self, cnots):
+        """ This function converts a CNOT dictionary into two integer arrays
+        with the positions of the connected ancilla and data qubits in the
+        condensed lists anc_l and data_l.
+
+        Input
+        -----
+        cnots -- a dictionary that describes how the cnots are connecting
+                 ancillas and data qubits
+
+        Output
+        ------
+        anc_idx, data_idx -- indices of the ancilla and data qubits
+        """
+
+        anc_keys = sorted(cnots.keys())
+        anc_idx = np.array([self.anc_l.index(qb) for qb in anc_keys],
+                           dtype=int)
+        data_idx = np.array([cnots[qb][0] * self.dist + cnots[qb][1]
+                            for qb in anc_keys], dtype=int)
+        return (anc_idx, data_idx)
+
+    def _cycle_thresholds(self):
+        """ This function returns the error probabilities of all random
+        numbers that make_run draws during one cycle (seven circuit steps),
+        in the order in which they are drawn. This allows to draw the random
+        numbers of a whole cycle at once and to reproduce make_run exactly.
+
+        Output
+        ------
+        thresholds -- array with one error probability per random number
+        """
+
+        anc_errs = np.tile([self.pax, self.pay, self.paz], self.n_anc)
+        data_errs = np.tile([self.pqx, self.pqy, self.pqz], self.n_data)
+        return np.concatenate(6 * [anc_errs, data_errs]
+                              + [np.full(self.n_data, self.pm),
+                                 np.full(self.n_anc, self.pm), data_errs])
+
+    def make_runs(self, seeds, n_steps, packed=False, sampling='dense'):
+        """ This function does the same as make_run with condensed=True, but
+        simulates many runs (shots) at once. Every shot uses its own random
+        number generator, seeded with its seed. With sampling='dense' each
+        shot draws the same random numbers in the same order as make_run.
+        Hence the output for a given seed is identical to the output of
+        make_run.
+
+        With sampling='sparse' only the error locations are drawn: for each
+        shot and error probability p the gaps between consecutive errors in
+        the (step x location) space are drawn from a geometric distribution.
+        This has the same statistics as the dense sampling, but the cost
+        scales with the number of errors instead of the number of locations,
+        which pays off for low error rates. The output is deterministic per
+        seed, but differs from the one of make_run.
+
+        With sampling='philox' the random numbers are counter-based (see
+        CounterRNG): the random number of an error location (step, qubit
+        and error type) in a cycle only depends on the seed, the cycle and
+        the location, not on the order in which the numbers are drawn.
+        The output for a given seed is identical to the output of make_run
+        with sampling='philox', and does not depend on the other shots of
+        the batch, nor on the number of steps beyond the cycle.
+
+        There are two representations of the error frames. By default they
+        are kept in boolean arrays of shape (n_shots, n_qubits, 2), and each
+        circuit step is executed as a whole-array operation. With packed=True
+        the bitflip- and phaseflip-errors are stored in separate uint64 bit
+        planes of shape (n_qubits, n_words), with one bit per shot. The
+        Hadamard and CNOT gates then act on 64 shots per word. The samplers
+        write the errors directly into words, and the events are calculated
+        on the words, only the outputs are unpacked. The packed frames are
+        fastest together with sampling='sparse', with the dense samplers
+        the run time is dominated by drawing one random number per error
+        location and shot.
+
+        Input
+        -----
+        seeds -- a list of seeds, one per shot
+        n_steps -- the number of steps (in sets of 7 circuit steps)
+        packed -- a flag determining if the bit-packed error frames are used
+        sampling -- 'dense', 'sparse' or 'philox', the way the errors are
+                    sampled
+
+        Output
+        ------
+        seeds -- the seeds that were used for the runs
+        syndromes, events, fstabs, err_signal, parities -- like in make_run,
+                    but with a leading shot axis
+        """
+
+        # An empty list of seeds (e.g. the last shard of a range) gives
+        # empty outputs with the usual shapes.
+
+        seeds = np.asarray(seeds)
+        n_shots = len(seeds)
+        if n_shots == 0:
+            seeds = seeds.astype(np.int64)
+
+        # # # Random number generators and error sampling # # #
+
+        if sampling == 'dense':
+            draw_errs = self._dense_sampler(seeds, packed)
+        elif sampling == 'sparse':
+            draw_errs = self._sparse_sampler(seeds, n_steps, packed)
+        elif sampling == 'philox':
+            draw_errs = self._philox_sampler(seeds, packed)
         else:
-            for s in range(n_steps):
-                first_deriv_z_only = np.zeros(shape=[self.dist + 1,
-                        self.dist + 1], dtype=bool)
-                for z_anc in self.z_anc_l:
-                    first_deriv_z_only[z_anc] = first_deriv[s][z_anc]
-                err_signal.append(np.bitwise_xor(fstabs[s],
-                                  first_deriv_z_only))
-        err_signal = np.array(err_signal, dtype=bool)
+            raise ValueError("sampling must be 'dense', 'sparse' or "
+                             "'philox', but is " + str(sampling))
+
+        if packed:
+            (syndromes, events, fstabs, err_signal, parities) = \
+                self._run_packed(n_shots, n_steps, draw_errs)
+        else:
+            (syndromes, fstabs, parities) = self._run_frames(n_shots,
+                    n_steps, draw_errs)
+            (events, err_signal) = self._calc_events(syndromes, fstabs)
 
         return (
-            seed,
+            seeds,
             syndromes,
             events,
             fstabs,
@@ -642,6 +770,406 @@ class SurfaceCode:
             parities,
             )
 
+    def make_fault_runs(self, cycles, locations, n_steps):
+        """ This function simulates runs without random errors, but with a
+        single fault each. Shot k has an error at the random number
+        locations[k] (in the order of _cycle_thresholds) of the cycle
+        cycles[k]. This gives the detection events and the effect on the
+        parity of every fault of the circuit, e.g. for building the
+        detector graph of a matching decoder.
+
+        Input
+        -----
+        cycles -- the cycle of the fault of every shot
+        locations -- the location of the fault of every shot
+        n_steps -- the number of steps (in sets of 7 circuit steps)
+
+        Output
+        ------
+        events, err_signal, parities -- like in make_runs
+        """
+
+        (cycles, locations) = (np.asarray(cycles), np.asarray(locations))
+        n_shots = len(cycles)
+        n_rands = len(self._cycle_thresholds())
+        cycle = [0]
+
+        def draw_errs():
+            errs = np.zeros(shape=[n_shots, n_rands], dtype=bool)
+            shots = np.flatnonzero(cycles == cycle[0])
+            errs[shots, locations[shots]] = True
+            cycle[0] += 1
+            return errs
+
+        (syndromes, fstabs, parities) = self._run_frames(n_shots, n_steps,
+                draw_errs)
+        (events, err_signal) = self._calc_events(syndromes, fstabs)
+        return (events, err_signal, parities)
+
+    def _calc_events(self, syndromes, fstabs, condensed=True):
+        """ This function calculates the events (second derivative of the
+        syndromes) and the error signal of a batch of runs. The derivatives
+        are XORs of the syndromes with the syndromes shifted by one or two
+        steps, over all shots and steps at once.
+
+        Input
+        -----
+        syndromes, fstabs -- like in make_run, with a leading shot axis
+        condensed -- a flag determining if the syndromes are condensed
+
+        Output
+        ------
+        events, err_signal -- like in make_run, with a leading shot axis
+        """
+
+        # First and second derivative (events) of the syndromes and the
+        # final error signal. In the uncondensed matrices only the z-ancillas
+        # of the first derivative enter the error signal.
+
+        first_deriv = syndromes.copy()
+        first_deriv[:, 1:] ^= syndromes[:, :-1]
+        events = syndromes.copy()
+        events[:, 2:] ^= syndromes[:, :-2]
+        if condensed:
+            err_signal = fstabs ^ first_deriv[:, :, self.z_indcs]
+        else:
+            err_signal = fstabs ^ (first_deriv & self.z_anc_mask)
+        return (events, err_signal)
+
+    def _dense_sampler(self, seeds, packed=False):
+        """ This function returns a function that draws the errors of one
+        cycle for all shots, using one random number per error location and
+        the same order of random numbers as make_run.
+
+        Input
+        -----
+        seeds -- a list of seeds, one per shot
+        packed -- a flag determining if the errors are packed into words,
+                  see _threshold_sampler
+
+        Output
+        ------
+        draw_errs -- a function returning the errors of the next cycle
+        """
+
+        rngs = [np.random.RandomState(seed) for seed in seeds]
+        n_rands = len(self._cycle_thresholds())
+        return self._threshold_sampler(len(seeds), lambda k, cycle:
+                rngs[k].random_sample(n_rands), packed)
+
+    def _philox_sampler(self, seeds, packed=False):
+        """ This function returns a function that draws the errors of one
+        cycle for all shots, using one counter-based random number per
+        error location (see CounterRNG). The numbers of every shot and
+        cycle are generated directly from (seed, cycle), without any state
+        carried over from the previous cycles or the other shots.
+
+        Input
+        -----
+        seeds -- a list of seeds, one per shot
+        packed -- a flag determining if the errors are packed into words,
+                  see _threshold_sampler
+
+        Output
+        ------
+        draw_errs -- a function returning the errors of the next cycle
+        """
+
+        n_rands = len(self._cycle_thresholds())
+        rngs = [CounterRNG(seed, n_rands) for seed in seeds]
+        return self._threshold_sampler(len(seeds), lambda k, cycle:
+                rngs[k].cycle_rands(cycle), packed)
+
+    def _threshold_sampler(self, n_shots, draw_rands, packed):
+        """ This function returns a function that draws the errors of one
+        cycle for all shots, by comparing one random number per error
+        location with its error probability. With packed=True the errors
+        are compared and packed per block of 64 shots, such that the
+        boolean errors of all shots are never stored at once.
+
+        Input
+        -----
+        n_shots -- the number of shots
+        draw_rands -- a function returning the n_rands random numbers of
+                      a shot in a cycle, draw_rands(shot, cycle)
+        packed -- a flag determining if the errors are packed into words
+
+        Output
+        ------
+        draw_errs -- a function returning the errors of the next cycle as a
+                     boolean array of shape (n_shots, n_rands), or as an
+                     uint64 array of shape (n_rands, n_words) with one bit
+                     per shot if packed
+        """
+
+        thresholds = self._cycle_thresholds()
+        n_words = (n_shots + 63) // 64
+        rands = np.empty(shape=[(min(n_shots, 64) if packed else n_shots),
+                         len(thresholds)])
+        cycle = [0]
+
+        def draw_errs():
+            if packed:
+                errs = np.empty(shape=[len(thresholds), n_words],
+                                dtype=np.uint64)
+                for w in range(n_words):
+                    block = range(64 * w, min(64 * w + 64, n_shots))
+                    for (j, k) in enumerate(block):
+                        rands[j] = draw_rands(k, cycle[0])
+                    errs[:, w] = _pack_shots(rands[:len(block)]
+                            < thresholds)[:, 0]
+            else:
+                for k in range(n_shots):
+                    rands[k] = draw_rands(k, cycle[0])
+                errs = rands < thresholds
+            cycle[0] += 1
+            return errs
+
+        return draw_errs
+
+    def _sparse_sampler(self, seeds, n_steps, packed=False):
+        """ This function returns a function that draws the errors of one
+        cycle for all shots. In contrast to _dense_sampler all errors of a
+        run are drawn in advance by geometric skipping: for each error
+        probability p, the locations with this probability in all n_steps
+        cycles form a flat space, and the gaps between consecutive errors in
+        this space are geometrically distributed with parameter p.
+
+        With packed=True only the bits of the drawn errors are set in the
+        words of the cycle, hence the cost of a cycle scales with the
+        number of errors instead of n_shots x n_rands.
+
+        Input
+        -----
+        seeds -- a list of seeds, one per shot
+        n_steps -- the number of steps (in sets of 7 circuit steps)
+        packed -- a flag determining if the errors are packed into words
+
+        Output
+        ------
+        draw_errs -- a function returning the errors of the next cycle, like
+                     in _threshold_sampler
+        """
+
+        thresholds = self._cycle_thresholds()
+        classes = [(p, np.flatnonzero(thresholds == p)) for p in
+                   np.unique(thresholds) if p > 0]
+
+        # Draw the error positions (shot, step, location) of all runs
+
+        # Reseeding a single RandomState gives the same numbers as a new
+        # RandomState(seed), but is much cheaper than creating one per shot.
+
+        (shot_l, step_l, loc_l) = ([], [], [])
+        rng = np.random.RandomState()
+        for (k, seed) in enumerate(seeds):
+            rng.seed(seed)
+            for (p, locs) in classes:
+                n_space = n_steps * len(locs)
+                n_mean = n_space * p
+                gaps = rng.geometric(p, size=int(n_mean + 5
+                                     * np.sqrt(n_mean) + 10))
+                pos = np.cumsum(gaps) - 1
+                while pos[-1] < n_space:
+                    gaps = rng.geometric(p, size=len(gaps))
+                    pos = np.concatenate((pos, pos[-1] + np.cumsum(gaps)))
+                pos = pos[pos < n_space]
+                shot_l.append(np.full(len(pos), k))
+                step_l.append(pos // len(locs))
+                loc_l.append(locs[pos % len(locs)])
+
+        if shot_l:
+            (shots, steps, locs) = (np.concatenate(shot_l),
+                                    np.concatenate(step_l),
+                                    np.concatenate(loc_l))
+        else:
+            (shots, steps, locs) = (np.zeros(0, dtype=int), ) * 3
+        order = np.argsort(steps, kind='stable')
+        (shots, steps, locs) = (shots[order], steps[order], locs[order])
+        bounds = np.searchsorted(steps, np.arange(n_steps + 1))
+        (words, bits) = (shots >> 6, np.left_shift(np.uint64(1),
+                         (shots & 63).astype(np.uint64)))
+        n_words = (len(seeds) + 63) // 64
+        cycle = [0]
+
+        def draw_errs():
+            (start, stop) = (bounds[cycle[0]], bounds[cycle[0] + 1])
+            if packed:
+                errs = np.zeros(shape=[len(thresholds), n_words],
+                                dtype=np.uint64)
+                np.bitwise_or.at(errs, (locs[start:stop],
+                                 words[start:stop]), bits[start:stop])
+            else:
+                errs = np.zeros(shape=[len(seeds), len(thresholds)],
+                                dtype=bool)
+                errs[shots[start:stop], locs[start:stop]] = True
+            cycle[0] += 1
+            return errs
+
+        return draw_errs
+
+    def _run_frames(self, n_shots, n_steps, draw_errs):
+        """ This function executes the circuit for all shots on boolean error
+        frames of shape (n_shots, n_qubits, 2).
+
+        Input
+        -----
+        n_shots -- the number of shots
+        n_steps -- the number of steps (in sets of 7 circuit steps)
+        draw_errs -- a function returning the errors of one cycle as a
+                     boolean array of shape (n_shots, n_rands)
+
+        Output
+        ------
+        syndromes, fstabs, parities -- condensed outputs with a leading
+                                       shot axis
+        """
+
+        (x_idcs, cnot_layers) = (self.had_indcs, self.cnot_indcs)
+
+        data = np.zeros(shape=[n_shots, self.n_data, 2], dtype=bool)
+        anc = np.zeros(shape=[n_shots, self.n_anc, 2], dtype=bool)
+        syndromes = np.zeros(shape=[n_shots, n_steps, self.n_anc],
+                             dtype=bool)
+        fstabs = np.zeros(shape=[n_shots, n_steps, self.n_z_stab],
+                          dtype=bool)
+        parities = np.zeros(shape=[n_shots, n_steps], dtype=bool)
+
+        def apply_errs(qubits, errs):
+
+            # errs holds the outcome of the three dice (x, y, z) per qubit
+
+            errs = errs.reshape(n_shots, qubits.shape[1], 3)
+            qubits[:, :, 0] ^= errs[:, :, 0] ^ errs[:, :, 1]
+            qubits[:, :, 1] ^= errs[:, :, 1] ^ errs[:, :, 2]
+
+        for s in range(n_steps):
+            errs = draw_errs()
+            offset = 0
+
+            # Steps 1 to 6
+
+            for step in range(6):
+                if step in [0, 5]:
+                    anc[:, x_idcs] = anc[:, x_idcs, ::-1]
+                else:
+                    ((xa, xd), (za, zd)) = cnot_layers[step - 1]
+                    data[:, xd, 0] ^= anc[:, xa, 0]
+                    anc[:, xa, 1] ^= data[:, xd, 1]
+                    anc[:, za, 0] ^= data[:, zd, 0]
+                    data[:, zd, 1] ^= anc[:, za, 1]
+                apply_errs(anc, errs[:, offset:offset + 3 * self.n_anc])
+                offset += 3 * self.n_anc
+                apply_errs(data, errs[:, offset:offset + 3 * self.n_data])
+                offset += 3 * self.n_data
+
+            # Final measurement of the data qubits
+
+            data_meas = data[:, :, 0] ^ errs[:, offset:offset
+                                             + self.n_data]
+            offset += self.n_data
+            fstabs[:, s] = self._get_z_stabs(data_meas)
+            parities[:, s] = self._get_parity(data_meas, axis=1)
+
+            # Step 7
+
+            syndromes[:, s] = anc[:, :, 0] ^ errs[:, offset:offset
+                                                  + self.n_anc]
+            offset += self.n_anc
+            anc[:, :, 1] = False
+            apply_errs(data, errs[:, offset:])
+
+        return (syndromes, fstabs, parities)
+
+    def _run_packed(self, n_shots, n_steps, draw_errs):
+        """ This function does the same as _run_frames, but stores the
+        bitflip- and phaseflip-errors of all shots in uint64 bit planes of
+        shape (n_qubits, n_words), one bit per shot.
+
+        Input
+        -----
+        n_shots -- the number of shots
+        n_steps -- the number of steps (in sets of 7 circuit steps)
+        draw_errs -- a function returning the errors of one cycle as an
+                     uint64 array of shape (n_rands, n_words), with one
+                     bit per shot
+
+        Output
+        ------
+        syndromes, events, fstabs, err_signal, parities -- condensed outputs
+                    with a leading shot axis
+        """
+
+        (x_idcs, cnot_layers, z_conn) = (self.had_indcs, self.cnot_indcs,
+                self.z_conn_indcs)
+        n_words = (n_shots + 63) // 64
+
+        (data_x, data_z) = (np.zeros(shape=[self.n_data, n_words],
+                            dtype=np.uint64) for _ in range(2))
+        (anc_x, anc_z) = (np.zeros(shape=[self.n_anc, n_words],
+                          dtype=np.uint64) for _ in range(2))
+        syndromes = np.zeros(shape=[n_steps, self.n_anc, n_words],
+                             dtype=np.uint64)
+        fstabs = np.zeros(shape=[n_steps, self.n_z_stab, n_words],
+                          dtype=np.uint64)
+        parities = np.zeros(shape=[n_steps, n_words], dtype=np.uint64)
+
+        def apply_errs(qubits_x, qubits_z, errs):
+
+            # errs holds the outcome of the three dice (x, y, z) per qubit
+
+            errs = errs.reshape(len(qubits_x), 3, n_words)
+            qubits_x ^= errs[:, 0] ^ errs[:, 1]
+            qubits_z ^= errs[:, 1] ^ errs[:, 2]
+
+        for s in range(n_steps):
+            errs = draw_errs()
+            offset = 0
+
+            # Steps 1 to 6
+
+            for step in range(6):
+                if step in [0, 5]:
+                    (anc_x[x_idcs], anc_z[x_idcs]) = (anc_z[x_idcs],
+                            anc_x[x_idcs])
+                else:
+                    ((xa, xd), (za, zd)) = cnot_layers[step - 1]
+                    data_x[xd] ^= anc_x[xa]
+                    anc_z[xa] ^= data_z[xd]
+                    anc_x[za] ^= data_x[zd]
+                    data_z[zd] ^= anc_z[za]
+                apply_errs(anc_x, anc_z, errs[offset:offset + 3
+                           * self.n_anc])
+                offset += 3 * self.n_anc
+                apply_errs(data_x, data_z, errs[offset:offset + 3
+                           * self.n_data])
+                offset += 3 * self.n_data
+
+            # Final measurement of the data qubits
+
+            data_meas = data_x ^ errs[offset:offset + self.n_data]
+            offset += self.n_data
+            for (k, conn) in enumerate(z_conn):
+                fstabs[s, k] = np.bitwise_xor.reduce(data_meas[conn],
+                        axis=0)
+            parities[s] = np.bitwise_xor.reduce(data_meas, axis=0)
+
+            # Step 7
+
+            syndromes[s] = anc_x ^ errs[offset:offset + self.n_anc]
+            offset += self.n_anc
+            anc_z[:] = 0
+            apply_errs(data_x, data_z, errs[offset:])
+
+        # The events and the error signal are calculated on the words, with
+        # the words in place of the shot axis, before unpacking.
+
+        (events, err_signal) = self._calc_events(syndromes.transpose(2, 0,
+                1), fstabs.transpose(2, 0, 1))
+        return tuple(_unpack_shots(words, n_shots) for words in
+                     (syndromes, events.transpose(1, 2, 0), fstabs,
+                      err_signal.transpose(1, 2, 0), parities))
+
     def get_info(self):
         """ This function returns some information about the variables that
         describe the surface code model.
@@ -662,3 +1190,116 @@ class SurfaceCode:
             'n_anc_qubits': self.n_anc,
             'n_z_stabs': self.n_z_stab,
             }
+
+
+class CounterRNG:
+
+    """
+      Counter-based random numbers of one run. The random numbers of the
+      cycle cycle are the doubles of a Philox stream, with the 128-bit key
+      derived from the seed by a SeedSequence and the counter
+      [0, cycle, 0, 0]. The random number of location loc (in the order of
+      SurfaceCode._cycle_thresholds, i.e. of the circuit step, the qubit
+      and the error type) is the loc-th double of this stream. Hence every
+      random number is a function of (seed, cycle, step, qubit) only, and
+      can be generated in any order, by any process.
+
+      rand draws the random numbers in sequence, like RandomState.rand, such
+      that make_run can use a CounterRNG instead of a RandomState.
+
+      Input
+      -----
+
+      seed -- the seed of the run, an integer or a sequence of integers
+      n_rands -- the number of random numbers per cycle
+      """
+
+    def __init__(self, seed, n_rands):
+        self.key = np.random.SeedSequence(seed).generate_state(2,
+                np.uint64)
+        self.n_rands = n_rands
+        self.bit_generator = np.random.Philox(key=self.key)
+        self.generator = np.random.Generator(self.bit_generator)
+        self.state = self.bit_generator.state
+
+        # Position of the next random number of rand, and the random
+        # numbers of the current cycle
+
+        self.pos = 0
+        (self.cycle, self.rands) = (None, None)
+
+    def cycle_rands(self, cycle):
+        """ This function returns the n_rands random numbers of a cycle.
+
+        Input
+        -----
+        cycle -- the number of the cycle
+
+        Output
+        ------
+        rands -- array of n_rands random numbers in [0, 1)
+        """
+
+        # Setting the state discards the buffered output of the previous
+        # cycle, the stream starts at the first double of the counter.
+
+        self.state['state']['counter'] = np.array([0, cycle, 0, 0],
+                dtype=np.uint64)
+        self.state['buffer_pos'] = 4
+        self.state['has_uint32'] = 0
+        self.bit_generator.state = self.state
+        return self.generator.random(self.n_rands)
+
+    def rand(self, *size):
+        """ This function returns the next random numbers in the order of
+        the locations and cycles, with the interface of RandomState.rand.
+
+        Input
+        -----
+        size -- the shape of the output, a single float if empty
+
+        Output
+        ------
+        rands -- random numbers in [0, 1)
+        """
+
+        n = int(np.prod(size))
+        rands = np.empty(n)
+        k = 0
+        while k < n:
+            (cycle, loc) = divmod(self.pos, self.n_rands)
+            if cycle != self.cycle:
+                (self.cycle, self.rands) = (cycle, self.cycle_rands(cycle))
+            m = min(n - k, self.n_rands - loc)
+            rands[k:k + m] = self.rands[loc:loc + m]
+            (k, self.pos) = (k + m, self.pos + m)
+        return rands.reshape(size) if size else rands[0]
+
+
+def _pack_shots(bits):
+    """ This function packs a boolean array of shape (n_shots, ...) into an
+    uint64 array of shape (..., n_words), with one bit per shot.
+    """
+
+    n_words = (len(bits) + 63) // 64
+    words = np.zeros(shape=(8 * n_words, ) + bits.shape[1:],
+                     dtype=np.uint8)
+    words[:(len(bits) + 7) // 8] = np.packbits(bits, axis=0,
+            bitorder='little')
+    words = np.ascontiguousarray(np.moveaxis(words, 0, -1))
+    return words.view('<u8')
+
+
+def _unpack_shots(words, n_shots):
+    """ This function is the inverse of _pack_shots. It unpacks an uint64
+    array of shape (..., n_words) into a boolean array of shape
+    (n_shots, ...).
+    """
+
+    # The bytes are moved to the front before unpacking, such that only
+    # the packed array is transposed and not the eight times larger bits.
+
+    words = np.ascontiguousarray(words, dtype='<u8').view(np.uint8)
+    words = np.ascontiguousarray(np.moveaxis(words, -1, 0))
+    bits = np.unpackbits(words, axis=0, count=n_shots, bitorder='little')
+    return bits.view(bool)
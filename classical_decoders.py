@@ -0,0 +1,558 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import shortest_path
+
+from SurfaceCode import SurfaceCode
+
+# networkx is only needed for the matching of MWPMDecoder
+try:
+  import networkx as nx
+except ImportError:
+  nx = None
+"""
+Classical decoders for the runs of SurfaceCode, as a reference for the neural
+decoders. All decoders estimate the final parity (see SurfaceCode.make_run)
+from the events and the final error signal of a batch of runs
+
+  parity = decoder.decode(events, final_err_signal)
+
+where events has the shape (n_shots, n_steps, n_anc) and final_err_signal the
+shape (n_shots, n_z_stab), in the condensed order of make_run. Only the
+z-stabilizers are used, since only bitflips change the parity. Events after
+the end of a (zero padded) run are ignored, since they are all zero.
+
+The matching decoders work on the space-time detector graph of the circuit,
+see DetectorGraph.
+"""
+
+class LookupTableDecoder:
+  """ Look-up table decoder for distance 3. For every pattern of the n_z_stab
+  z-stabilizers the table holds the parity of the minimum weight bitflip
+  correction with this syndrome, which is found by enumerating all bitflip
+  patterns of the data qubits with the connections in z_anc_data_conn. All
+  corrections of minimum weight have the same parity, since the stabilizers of
+  the code have an even and the logical operators an odd weight.
+
+  The z-events are combined (xor) in windows of window cycles, and the table
+  is applied to every window and to the final error signal. The parities of
+  the corrections add up to the estimate of the final parity. A measurement
+  error (events two cycles apart) or an ancilla error (events in consecutive
+  cycles) gives the same pattern twice and cancels, while a data error whose
+  events are spread over two consecutive cycles is combined in the window.
+
+  Input
+  -----
+
+  distance - the distance of the code, at most 3
+  window - the number of cycles that are decoded together
+  """
+  def __init__(self, distance=3, window=3):
+    if distance > 3:
+      raise ValueError("The look-up table is only built for distance 3, use MWPMDecoder or "
+                       "UnionFindDecoder for larger distances")
+    surf = SurfaceCode(seed=0, distance=distance)
+    self.z_indcs = np.array(surf.z_indcs, dtype=int)
+    self.window = window
+    n_z, n_data = surf.n_z_stab, surf.n_data
+
+    # syndromes and weights of all 2**n_data bitflip patterns
+    patterns = (np.arange(2**n_data)[:, None] >> np.arange(n_data)) & 1
+    syndromes = np.zeros(2**n_data, dtype=int)
+    for (k, conn) in enumerate(surf.z_conn_indcs):
+      syndromes |= (patterns[:, conn].sum(axis=1) % 2) << k
+    weights = patterns.sum(axis=1)
+
+    # the minimum weight per syndrome, visited in the order of increasing weight
+    self.table = np.zeros(2**n_z, dtype=bool)
+    found = np.zeros(2**n_z, dtype=bool)
+    for p in np.argsort(weights, kind='stable'):
+      if not found[syndromes[p]]:
+        found[syndromes[p]] = True
+        self.table[syndromes[p]] = weights[p] % 2
+    self.powers = 1 << np.arange(n_z)
+    return
+
+  def decode(self, events, final_err_signal):
+    """ Returns the estimated final parity of every run.
+
+    Input
+    -----
+
+    events - the events of shape (n_shots, n_steps, n_anc)
+    final_err_signal - the error signal after the last cycle, of shape (n_shots, n_z_stab)
+    """
+    z_events = np.asarray(events, dtype=bool)[:, :, self.z_indcs]
+    (n_shots, n_steps, n_z) = z_events.shape
+    n_windows = -(-n_steps // self.window)
+    padded = np.zeros((n_shots, n_windows * self.window, n_z), dtype=bool)
+    padded[:, :n_steps] = z_events
+    windows = np.logical_xor.reduce(padded.reshape(n_shots, n_windows, self.window, n_z), axis=2)
+
+    parity = np.logical_xor.reduce(self.table[windows.dot(self.powers)], axis=1)
+    return parity ^ self.table[np.asarray(final_err_signal, dtype=int).dot(self.powers)]
+
+
+class DetectorGraph:
+  """ The space-time graph of the detectors of runs with n_steps cycles. The
+  detectors are the z-events of every cycle and the final error signal, the
+  detector t * n_z_stab + k is the z-stabilizer k (in sorted order) of the
+  cycle t, where t = n_steps is the final error signal. The node n_det is the
+  boundary.
+
+  Every single fault of the circuit (one of the random numbers of
+  SurfaceCode._cycle_thresholds) flips one or two detectors, and is an edge
+  between them, or between the detector and the boundary. The faults are found
+  by simulating every fault of the circuit on its own with
+  SurfaceCode.make_fault_runs. Faults with the same detectors and the same
+  effect on the parity are combined, of two faults with the same detectors and
+  a different effect on the parity the more likely one is kept.
+
+  Since the events of a fault are local in time, only the faults of a run with
+  at most 7 cycles are simulated: the first three cycles, a cycle in the bulk,
+  which is repeated for longer runs, and the last three cycles.
+
+  Input
+  -----
+
+  surf_params - keyword arguments of SurfaceCode (without the seed)
+  n_steps - the number of cycles
+
+  Attributes
+  ----------
+
+  n_det - the number of detectors
+  edges - array of shape (n_edges, 2) with the nodes of every edge
+  probs - the probability of every edge
+  weights - the weight log((1 - p) / p) of every edge
+  flips - whether the faults of an edge flip the parity
+  """
+
+  # graphs of the (SurfaceCode parameters, n_steps) that were built before
+  _graphs = {}
+
+  @classmethod
+  def get(cls, surf_params, n_steps):
+    """ Returns the (cached) graph of the given parameters. """
+    key = (tuple(sorted(surf_params.items())), n_steps)
+    if key not in cls._graphs:
+      cls._graphs[key] = cls(surf_params, n_steps)
+    return cls._graphs[key]
+
+  def __init__(self, surf_params, n_steps):
+    surf = SurfaceCode(seed=0, **surf_params)
+    self.n_steps = n_steps
+    self.n_z = surf.n_z_stab
+    self.z_indcs = np.array(surf.z_indcs, dtype=int)
+    self.n_det = (n_steps + 1) * self.n_z
+
+    # simulate every fault of a short run
+    thresholds = surf._cycle_thresholds()
+    locations = np.flatnonzero(thresholds > 0)
+    n_small = min(n_steps, 7)
+    cycles = np.repeat(np.arange(n_small), len(locations))
+    locations = np.tile(locations, n_small)
+    (events, err_signal, parities) = surf.make_fault_runs(cycles, locations, n_small)
+    dets = np.concatenate((events[:, :, self.z_indcs].reshape(len(cycles), -1),
+                           err_signal[:, -1]), axis=1)
+    n_flipped = dets.sum(axis=1)
+    if n_flipped.max() > 2:
+      raise ValueError("A single fault flips more than two detectors")
+
+    # the detectors of every fault, the second one is the boundary (n_small_det)
+    # for faults with a single detector
+    n_small_det = dets.shape[1]
+    fault = n_flipped > 0
+    (dets, cycles, probs, flips) = (dets[fault], cycles[fault], thresholds[locations[fault]],
+                                    parities[fault, -1])
+    first = dets.argmax(axis=1)
+    second = np.where(n_flipped[fault] == 2, n_small_det - 1 - dets[:, ::-1].argmax(axis=1),
+                      n_small_det)
+
+    # Place the faults of the short run in the long run. The cycles 0 to 3 stay,
+    # the cycle 3 is repeated for the cycles 4 to n_steps - 4, and the last
+    # three cycles are moved to the end.
+    shifts = np.where(cycles > 3, n_steps - n_small, 0)
+    if n_steps > n_small:
+      bulk = np.flatnonzero(cycles == 3)
+      n_rep = n_steps - n_small
+      faults = np.concatenate((np.arange(len(cycles)), np.tile(bulk, n_rep)))
+      shifts = np.concatenate((shifts, np.repeat(np.arange(1, n_rep + 1), len(bulk))))
+      (first, second, probs, flips) = (first[faults], second[faults], probs[faults], flips[faults])
+    first = first + shifts * self.n_z
+    second = np.where(second == n_small_det, self.n_det, second + shifts * self.n_z)
+    self._combine(first, second, probs, flips)
+    return
+
+  def _combine(self, first, second, probs, flips):
+    # combines the faults with the same detectors and effect on the parity. The
+    # probability of an odd number of independent faults is (1 - prod(1 - 2p)) / 2.
+    keys = np.stack((first, second, flips), axis=1)
+    (keys, inverse) = np.unique(keys, axis=0, return_inverse=True)
+    log_q = np.zeros(len(keys))
+    np.add.at(log_q, inverse.ravel(), np.log(1. - 2. * probs))
+    p = (1. - np.exp(log_q)) / 2.
+
+    # of the faults with the same detectors, the most likely is kept
+    order = np.lexsort((-p, keys[:, 1], keys[:, 0]))
+    (keys, p) = (keys[order], p[order])
+    keep = np.ones(len(keys), dtype=bool)
+    keep[1:] = np.any(keys[1:, :2] != keys[:-1, :2], axis=1)
+
+    self.edges = keys[keep, :2]
+    self.flips = keys[keep, 2].astype(bool)
+    self.probs = p[keep]
+    self.weights = np.log((1. - self.probs) / self.probs)
+    return
+
+  def get_detectors(self, events, final_err_signal):
+    """ Returns the detectors of the runs as a boolean array of shape (n_shots, n_det). """
+    events = np.asarray(events, dtype=bool)[:, :self.n_steps, self.z_indcs]
+    return np.concatenate((events.reshape(len(events), -1),
+                           np.asarray(final_err_signal, dtype=bool)), axis=1)
+
+class MWPMDecoder:
+  """ Minimum weight perfect matching decoder on the DetectorGraph. The
+  distances and the parities of the shortest paths between all pairs of
+  detectors are computed once per (SurfaceCode parameters, n_steps) and cached.
+  The flipped detectors of every run are matched to each other or to the
+  boundary (with networkx.max_weight_matching), and the estimated parity is
+  the parity of the faults on the shortest paths between the matched pairs.
+
+  Input
+  -----
+
+  surf_params - keyword arguments of SurfaceCode (without the seed)
+  """
+
+  # (distances, parities) of the shortest paths per DetectorGraph
+  _paths = {}
+
+  def __init__(self, surf_params):
+    if nx is None:
+      raise ImportError("MWPMDecoder requires networkx")
+    self.surf_params = surf_params
+    return
+
+  def get_paths(self, n_steps):
+    """ Returns the graph of runs with n_steps cycles and the distances and the
+    parities of the shortest paths between all pairs of its nodes. """
+    graph = DetectorGraph.get(self.surf_params, n_steps)
+    if graph not in self._paths:
+      n = graph.n_det + 1
+      (u, v) = (graph.edges[:, 0], graph.edges[:, 1])
+      (dist, pred) = shortest_path(coo_matrix((graph.weights, (u, v)), shape=(n, n)).tocsr(),
+                                   method='D', directed=False, return_predecessors=True)
+
+      # The parity of the path from s to t is the parity of the path from s to
+      # the predecessor of t plus the parity of the last edge. It is
+      # accumulated along the paths by pointer jumping.
+      edge_flips = np.zeros((n, n), dtype=bool)
+      edge_flips[u, v] = edge_flips[v, u] = graph.flips
+      rows = np.arange(n)[:, None]
+      pred = np.where(pred < 0, rows, pred)
+      parity = edge_flips[pred, np.arange(n)[None, :]]
+      while np.any(pred != rows):
+        parity ^= parity[rows, pred]
+        pred = pred[rows, pred]
+      self._paths[graph] = (dist, parity)
+    return (graph, ) + self._paths[graph]
+
+  def _match(self, defects, dist, parity, boundary):
+    # matches the flipped detectors of one run, every detector has its own
+    # copy of the boundary, the copies are connected to each other at no cost
+    d = dist[np.ix_(defects, defects)]
+    d_b = dist[defects, boundary]
+    big = 1. + 2. * d_b.max()
+    G = nx.Graph()
+    for i in range(len(defects)):
+      G.add_edge(i, -1 - i, weight=big - d_b[i])
+      for j in range(i + 1, len(defects)):
+        G.add_edge(-1 - i, -1 - j, weight=big)
+        if d[i, j] < d_b[i] + d_b[j]:
+          G.add_edge(i, j, weight=big - d[i, j])
+
+    result = False
+    for (i, j) in nx.max_weight_matching(G, maxcardinality=True):
+      (i, j) = (min(i, j), max(i, j))
+      if i >= 0:
+        result ^= parity[defects[i], defects[j]]
+      elif j >= 0:
+        result ^= parity[defects[j], boundary]
+    return result
+
+  def decode(self, events, final_err_signal, lengths=None):
+    """ Returns the estimated final parity of every run.
+
+    Input
+    -----
+
+    events - the events of shape (n_shots, n_steps, n_anc)
+    final_err_signal - the error signal after the last cycle, of shape (n_shots, n_z_stab)
+    lengths - the number of cycles of every run (for zero padded events), by
+              default all runs have n_steps cycles
+    """
+    events = np.asarray(events, dtype=bool)
+    if lengths is None:
+      lengths = np.full(len(events), events.shape[1])
+    lengths = np.asarray(lengths)
+
+    parity = np.zeros(len(events), dtype=bool)
+    for n_steps in np.unique(lengths):
+      shots = np.flatnonzero(lengths == n_steps)
+      (graph, dist, path_parity) = self.get_paths(int(n_steps))
+      dets = graph.get_detectors(events[shots], np.asarray(final_err_signal)[shots])
+      for (k, shot) in enumerate(shots):
+        defects = np.flatnonzero(dets[k])
+        if len(defects) > 0:
+          parity[shot] = self._match(defects, dist, path_parity, graph.n_det)
+    return parity
+
+class UnionFindDecoder:
+  """ Union-find decoder on the DetectorGraph. Every flipped detector starts a
+  cluster, and the clusters with an odd number of flipped detectors that do not
+  contain the boundary grow along their edges, until all clusters are even or
+  contain the boundary. The clusters are merged with a union-find structure.
+  Afterwards, the grown edges are peeled from a spanning forest (with the
+  boundary as a root), and the estimated parity is the parity of the faults on
+  the peeled edges.
+
+  Every edge has an integer length, its weight in units of the smallest weight
+  times resolution (rounded), such that unlikely edges need more growth steps.
+  The arrays of the union-find structure and of the growth of the edges are
+  allocated once per graph and only the touched entries are reset after every
+  run, such that the cost of a run grows almost linearly with the number of
+  flipped detectors.
+
+  Input
+  -----
+
+  surf_params - keyword arguments of SurfaceCode (without the seed)
+  resolution - the number of growth steps of the edges with the smallest weight
+  """
+  def __init__(self, surf_params, resolution=2):
+    self.surf_params = surf_params
+    self.resolution = resolution
+    self.arrays = {}
+    return
+
+  def get_arrays(self, n_steps):
+    """ Returns the graph of runs with n_steps cycles and the arrays of the
+    decoder: the adjacency lists, the edges and their lengths, the state of the
+    union-find structure and the state of the peeling. """
+    graph = DetectorGraph.get(self.surf_params, n_steps)
+    if graph not in self.arrays:
+      n = graph.n_det + 1
+      (u, v) = (graph.edges[:, 0], graph.edges[:, 1])
+      ends = np.concatenate((u, v))
+      order = np.argsort(ends, kind='stable')
+      lengths = np.rint(self.resolution * graph.weights / graph.weights.min())
+      self.arrays[graph] = {
+        'adj_ptr': np.searchsorted(ends[order], np.arange(n + 1)).tolist(),
+        'adj_node': np.concatenate((v, u))[order].tolist(),
+        'adj_edge': np.tile(np.arange(len(u)), 2)[order].tolist(),
+        'edges': graph.edges.tolist(),
+        'flips': graph.flips.tolist(),
+        'length': np.maximum(1, lengths).astype(int).tolist(),
+        'parent': list(range(n)),
+        'size': [0] * n,
+        'next': list(range(n)),
+        'odd': [False] * n,
+        'boundary': [False] * graph.n_det + [True],
+        'growth': [0] * len(u),
+        'forest': list(range(n)),
+        'in_forest': [False] * len(u),
+        'to_boundary': [-1] * n,
+        'flipped': [False] * n,
+        'tree_odd': [False] * n,
+        'tree_root': [-1] * n,
+        'tree_edge': [-1] * n}
+    return (graph, self.arrays[graph])
+
+  def _decode_run(self, defects, graph, a):
+    # decodes the flipped detectors of one run, see the class documentation
+    (parent, size, nxt) = (a['parent'], a['size'], a['next'])
+    (odd, boundary, growth) = (a['odd'], a['boundary'], a['growth'])
+    (adj_ptr, adj_node, adj_edge) = (a['adj_ptr'], a['adj_node'], a['adj_edge'])
+    (edges, length) = (a['edges'], a['length'])
+
+    def find(x):
+      root = x
+      while parent[root] != root:
+        root = parent[root]
+      while parent[x] != root:
+        (parent[x], x) = (root, parent[x])
+      return root
+
+    def union(x, y):
+      # the members of a cluster form a circular list through next, which is
+      # spliced into the list of the larger cluster
+      (x, y) = (find(x), find(y))
+      if x != y:
+        if size[x] < size[y]:
+          (x, y) = (y, x)
+        parent[y] = x
+        size[x] += size[y]
+        odd[x] ^= odd[y]
+        boundary[x] |= boundary[y]
+        (nxt[x], nxt[y]) = (nxt[y], nxt[x])
+
+    # every flipped detector is a cluster, a vertex of size 0 is in no cluster
+    for d in defects:
+      size[d] = 1
+      odd[d] = True
+    touched = list(defects)
+    (touched_edges, grown) = ([], [])
+
+    # grow the odd clusters, until they are even or contain the boundary
+    active = list(defects)
+    while active:
+      fused = []
+      for root in active:
+        w = root
+        while True:
+          for k in range(adj_ptr[w], adj_ptr[w + 1]):
+            e = adj_edge[k]
+            if growth[e] < length[e] and find(adj_node[k]) != root:
+              if growth[e] == 0:
+                touched_edges.append(e)
+              growth[e] += 1
+              if growth[e] == length[e]:
+                fused.append(e)
+          w = nxt[w]
+          if w == root:
+            break
+      for e in fused:
+        for x in edges[e]:
+          if size[x] == 0:
+            size[x] = 1
+            touched.append(x)
+        union(*edges[e])
+        grown.append(e)
+      # every fused edge was grown by an active cluster, hence the clusters
+      # that are still odd are found from the roots of the active clusters
+      active = [root for root in dict.fromkeys(map(find, active))
+                if odd[root] and not boundary[root]]
+
+    parity = self._peel(defects, grown, touched, graph.n_det, a)
+
+    # reset the touched entries
+    for x in touched:
+      parent[x] = x
+      size[x] = 0
+      nxt[x] = x
+      odd[x] = False
+      boundary[x] = x == graph.n_det
+    for e in touched_edges:
+      growth[e] = 0
+    return parity
+
+  def _peel(self, defects, grown, touched, boundary, a):
+    # Spanning forest of the grown edges between detectors, the shorter edges
+    # are preferred. The boundary is not part of the forest: it joins both
+    # sides of the code, which would connect corrections of a different parity.
+    # A tree with an odd number of flipped detectors is instead rooted at its
+    # shortest grown edge to the boundary. All vertices of the grown edges are
+    # in touched, which are the only entries that are reset afterwards.
+    (forest, in_forest, to_boundary) = (a['forest'], a['in_forest'], a['to_boundary'])
+    (flipped, tree_odd, tree_root, tree_edge) = (a['flipped'], a['tree_odd'], a['tree_root'],
+                                                 a['tree_edge'])
+    (adj_ptr, adj_node, adj_edge) = (a['adj_ptr'], a['adj_node'], a['adj_edge'])
+    (edges, flips, length) = (a['edges'], a['flips'], a['length'])
+
+    def find(x):
+      while forest[x] != x:
+        (forest[x], x) = (forest[forest[x]], forest[x])
+      return x
+
+    grown.sort(key=length.__getitem__)
+    for e in grown:
+      (x, y) = edges[e]
+      if y == boundary:
+        if to_boundary[x] < 0:
+          to_boundary[x] = e
+      else:
+        (x, y) = (find(x), find(y))
+        if x != y:
+          forest[x] = y
+          in_forest[e] = True
+
+    # the parity of the flipped detectors and the best root of every tree
+    for d in defects:
+      flipped[d] = True
+    for x in touched:
+      if x != boundary:
+        root = find(x)
+        tree_odd[root] ^= flipped[x]
+        if to_boundary[x] >= 0 and (tree_root[root] < 0 or
+                                    length[to_boundary[x]] < length[to_boundary[tree_root[root]]]):
+          tree_root[root] = x
+
+    # peel every tree from its leaves, the vertices of all trees are listed in
+    # order, each tree in breadth first order from its root
+    parity = False
+    order = []
+    for root in touched:
+      if root == boundary or forest[root] != root:
+        continue
+      if tree_odd[root]:
+        root = tree_root[root]
+        parity ^= flips[to_boundary[root]]
+        flipped[root] ^= True
+      start = len(order)
+      order.append(root)
+      i = start
+      while i < len(order):
+        x = order[i]
+        i += 1
+        for k in range(adj_ptr[x], adj_ptr[x + 1]):
+          e = adj_edge[k]
+          if in_forest[e] and e != tree_edge[x]:
+            tree_edge[adj_node[k]] = e
+            order.append(adj_node[k])
+      for j in range(len(order) - 1, start, -1):
+        x = order[j]
+        if flipped[x]:
+          e = tree_edge[x]
+          parity ^= flips[e]
+          flipped[x] = False
+          y = edges[e][0] + edges[e][1] - x
+          flipped[y] ^= True
+
+    # reset the touched entries
+    for x in touched:
+      forest[x] = x
+      to_boundary[x] = -1
+      flipped[x] = False
+      tree_odd[x] = False
+      tree_root[x] = -1
+      tree_edge[x] = -1
+    for e in grown:
+      in_forest[e] = False
+    return parity
+
+  def decode(self, events, final_err_signal, lengths=None):
+    """ Returns the estimated final parity of every run.
+
+    Input
+    -----
+
+    events - the events of shape (n_shots, n_steps, n_anc)
+    final_err_signal - the error signal after the last cycle, of shape (n_shots, n_z_stab)
+    lengths - the number of cycles of every run (for zero padded events), by
+              default all runs have n_steps cycles
+    """
+    events = np.asarray(events, dtype=bool)
+    if lengths is None:
+      lengths = np.full(len(events), events.shape[1])
+    lengths = np.asarray(lengths)
+
+    parity = np.zeros(len(events), dtype=bool)
+    for n_steps in np.unique(lengths):
+      shots = np.flatnonzero(lengths == n_steps)
+      (graph, arrays) = self.get_arrays(int(n_steps))
+      dets = graph.get_detectors(events[shots], np.asarray(final_err_signal)[shots])
+      for (k, shot) in enumerate(shots):
+        defects = np.flatnonzero(dets[k]).tolist()
+        if defects:
+          parity[shot] = self._decode_run(defects, graph, arrays)
+    return parity
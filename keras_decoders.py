@@ -13,6 +13,11 @@ def print_t(str_):
 """ 
 This is a simple decoder, that gets only the syndromes (without final syndromes)
 and the measured parity. 
+
+With xshape=(None, dim_syndr) the number of cycles may vary between batches (see
+the bucketing of SQLBatchGenerators.SimpleBatchGenerator). The output of all
+cycles can then not be flattened, and only the output of the last LSTM after
+the last cycle is passed to the dense layers.
 """
 class SimpleDecoder:
     def __init__(self, xshape, hidden_size=64):
@@ -28,9 +33,12 @@ class SimpleDecoder:
         x = LSTM(self.hidden_size, return_sequences=True)(x)
         #x = Dropout(0.5)(x)
         x = LSTM(self.hidden_size, return_sequences=True)(x)
-        x = LSTM(self.hidden_size, return_sequences=True)(x)
-        #x = Dropout(0.5)(x)
-        x = Flatten()(x)
+        if self.xshape[0] is None:
+            x = LSTM(self.hidden_size, return_sequences=False)(x)
+        else:
+            x = LSTM(self.hidden_size, return_sequences=True)(x)
+            #x = Dropout(0.5)(x)
+            x = Flatten()(x)
         x = Dense(256, activation='relu')(x)
         #x = Dropout(0.25)(x)
         x = Dense(128, activation='relu')(x)
@@ -0,0 +1,192 @@
+import json
+import numpy as np
+"""
+Inference of the trained keras decoders (keras_decoders.SimpleDecoder and the
+BaselineDecoder of QEC_full) with numpy only. export_weights writes the layers
+and weights of a model to a single .npz file, NumpyDecoder reads it without
+importing keras and computes the forward pass of a whole batch at once.
+"""
+
+# the layers that can be exported, see export_weights
+_supported_layers = ['InputLayer', 'LSTM', 'Dense', 'Flatten', 'Dropout']
+
+def export_weights(model, fname):
+  """ Writes the layers and the weights of a keras model to fname (.npz). The
+  model must be a chain of the layers in _supported_layers, like the models of
+  SimpleDecoder.create_model() and BaselineDecoder.create_model().
+
+  Input
+  -----
+
+  model - the keras model
+  fname - the name of the file
+  """
+  layers = []
+  weights = {}
+  for layer in model.layers:
+    class_name = layer.__class__.__name__
+    if class_name not in _supported_layers:
+      raise ValueError("The layer " + layer.name + " of type " + class_name + " can not be exported")
+    config = layer.get_config()
+    layers.append({'class_name': class_name,
+                   'activation': config.get('activation'),
+                   'recurrent_activation': config.get('recurrent_activation'),
+                   'return_sequences': config.get('return_sequences')})
+    for (k, w) in enumerate(layer.get_weights()):
+      weights['layer{0}_{1}'.format(len(layers) - 1, k)] = w
+  np.savez(fname, layers=json.dumps(layers), **weights)
+  return
+
+def _hard_sigmoid(x):
+  # the hard sigmoid of keras, which is the default recurrent activation of LSTM
+  return np.clip(0.2 * x + 0.5, 0., 1.)
+
+def _sigmoid(x):
+  return 1. / (1. + np.exp(-x))
+
+def _relu(x):
+  return np.maximum(x, 0.)
+
+_activations = {'linear': lambda x: x, None: lambda x: x, 'relu': _relu, 'tanh': np.tanh,
+                'sigmoid': _sigmoid, 'hard_sigmoid': _hard_sigmoid}
+
+class NumpyDecoder:
+  """ Forward pass of a model that was exported with export_weights.
+
+  Input
+  -----
+
+  fname - the file written by export_weights
+  dtype - the floating point type of the computation
+  """
+  def __init__(self, fname, dtype=np.float32):
+    data = np.load(fname)
+    self.layers = json.loads(str(data['layers']))
+    self.dtype = dtype
+    self.weights = []
+    for (i, layer) in enumerate(self.layers):
+      n_weights = {'LSTM': 3, 'Dense': 2}.get(layer['class_name'], 0)
+      self.weights.append([data['layer{0}_{1}'.format(i, k)].astype(dtype) for k in range(n_weights)])
+      for name in ['activation', 'recurrent_activation']:
+        if layer[name] not in _activations:
+          raise ValueError("The activation " + layer[name] + " is not supported")
+    return
+
+  def _lstm(self, x, layer, weights):
+    """ LSTM layer of keras on a batch x of shape (n, steps, features). The
+    input contributions of all steps are computed in one product, only the
+    recurrent part is computed step by step. The gates are ordered as in keras
+    (input, forget, cell, output). """
+    kernel, recurrent_kernel, bias = weights
+    act = _activations[layer['activation']]
+    rec_act = _activations[layer['recurrent_activation']]
+    n, n_steps, _ = x.shape
+    units = recurrent_kernel.shape[0]
+
+    x_in = np.dot(x, kernel) + bias
+    h = np.zeros((n, units), dtype=self.dtype)
+    c = np.zeros((n, units), dtype=self.dtype)
+    if layer['return_sequences']:
+      hs = np.empty((n, n_steps, units), dtype=self.dtype)
+    for t in range(n_steps):
+      h, c = _lstm_step(x_in[:, t], h, c, recurrent_kernel, act, rec_act)
+      if layer['return_sequences']:
+        hs[:, t] = h
+    return hs if layer['return_sequences'] else h
+
+  def predict(self, X, batch_size=None):
+    """ Returns the output of the model for the inputs X, like model.predict.
+
+    Input
+    -----
+
+    X - the inputs of shape (n, steps, features)
+    batch_size - the number of samples that are processed at once, all by default
+    """
+    X = np.asarray(X, dtype=self.dtype)
+    if batch_size is not None and len(X) > batch_size:
+      return np.concatenate([self.predict(X[k:k + batch_size]) for k in range(0, len(X), batch_size)])
+    x = X
+    for (layer, weights) in zip(self.layers, self.weights):
+      if layer['class_name'] == 'LSTM':
+        x = self._lstm(x, layer, weights)
+      elif layer['class_name'] == 'Dense':
+        x = _activations[layer['activation']](np.dot(x, weights[0]) + weights[1])
+      elif layer['class_name'] == 'Flatten':
+        x = x.reshape([len(x), -1])
+    return x
+
+def _lstm_step(x_in, h, c, recurrent_kernel, act, rec_act):
+  # one step of an LSTM, x_in is the input contribution to the gates (including the bias)
+  z = x_in + np.dot(h, recurrent_kernel)
+  units = h.shape[1]
+  i = rec_act(z[:, :units])
+  f = rec_act(z[:, units:2 * units])
+  c = f * c + i * act(z[:, 2 * units:3 * units])
+  o = rec_act(z[:, 3 * units:])
+  return o * act(c), c
+
+class StreamingDecoder:
+  """ Decodes the syndromes of n_qubits logical qubits cycle by cycle. The
+  hidden states of the LSTMs are kept between the cycles, such that every call
+  of step only computes one step of every layer, and returns the current
+  estimate of the parity.
+
+  This requires a model that does not flatten the output of all cycles, i.e.
+  a SimpleDecoder with xshape=(None, dim_syndr). After t cycles, the estimate
+  equals the output of the model for the sequence of these t cycles.
+
+  Input
+  -----
+
+  decoder - a NumpyDecoder
+  n_qubits - the number of logical qubits that are decoded simultaneously
+  """
+  def __init__(self, decoder, n_qubits=1):
+    self.decoder = decoder
+    self.n_qubits = n_qubits
+    self.dtype = decoder.dtype
+    for layer in decoder.layers:
+      if layer['class_name'] == 'Flatten':
+        raise ValueError("A model with a Flatten layer needs the whole sequence and can not be streamed")
+    lstms = [layer for layer in decoder.layers if layer['class_name'] == 'LSTM']
+    if not lstms or lstms[-1]['return_sequences']:
+      raise ValueError("The last LSTM of the model must return only its last output")
+    self.reset()
+    return
+
+  def reset(self, qubits=None):
+    """ Resets the hidden states of the given qubits (all by default) to the
+    start of a new run. """
+    if qubits is None:
+      self.states = [(np.zeros((self.n_qubits, w[1].shape[0]), dtype=self.dtype),
+                      np.zeros((self.n_qubits, w[1].shape[0]), dtype=self.dtype))
+                     if layer['class_name'] == 'LSTM' else None
+                     for (layer, w) in zip(self.decoder.layers, self.decoder.weights)]
+    else:
+      for state in self.states:
+        if state is not None:
+          state[0][qubits] = 0.
+          state[1][qubits] = 0.
+    return
+
+  def step(self, syndromes):
+    """ Processes one cycle and returns the estimates of the parity.
+
+    Input
+    -----
+
+    syndromes - the syndromes (events) of this cycle, of shape (n_qubits, dim_syndr)
+    """
+    x = np.asarray(syndromes, dtype=self.dtype)
+    for (k, (layer, weights)) in enumerate(zip(self.decoder.layers, self.decoder.weights)):
+      if layer['class_name'] == 'LSTM':
+        kernel, recurrent_kernel, bias = weights
+        h, c = _lstm_step(np.dot(x, kernel) + bias, self.states[k][0], self.states[k][1],
+                          recurrent_kernel, _activations[layer['activation']],
+                          _activations[layer['recurrent_activation']])
+        self.states[k] = (h, c)
+        x = h
+      elif layer['class_name'] == 'Dense':
+        x = _activations[layer['activation']](np.dot(x, weights[0]) + weights[1])
+    return x
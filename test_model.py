@@ -24,6 +24,11 @@ from SQLBatchGenerators import SimpleBatchGenerator
 bg=SimpleBatchGenerator(training_fname, validation_fname, test_fname, batch_size=5000, mode='training')
 bgv=SimpleBatchGenerator(training_fname, validation_fname, test_fname, batch_size=2000, mode='validation')
 
+# the validation samples of the roc curves are fetched once and kept in memory
+from CachedBatchGenerators import CachedBatchGenerator
+
+bgv_cached=CachedBatchGenerator(bgv, n_batches=1)
+
 # Test models
 from keras_decoders import SimpleDecoder
 
@@ -43,8 +48,7 @@ def print_t(str_):
 
 class test_callback(Callback):
   def __init__(self):
-    self.X = bgv.__getitem__(0)[0]
-    self.y = bgv.__getitem__(0)[1]
+    self.X, self.y = bgv_cached[0]
   
   def on_train_begin(self, logs={}):
     return